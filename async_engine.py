@@ -0,0 +1,212 @@
+"""An asyncio front end to move_by_regex, for running searches and moves from
+within an existing event loop - e.g a service which archives several volumes
+at once - rather than spawning a process per job. Needs Python 3.6 or later.
+
+Every filesystem call is made on a thread from a bounded executor, so the
+event loop itself never blocks on a slow mount. The walk and the moves are
+joined by a bounded queue: when moves fall behind, the walk waits for them
+rather than piling up matches. Cancelling the task running move_source
+stops the walk straight away; moves already under way are allowed to finish,
+so nothing is left half copied.
+"""
+
+import asyncio
+import concurrent.futures
+import os
+
+import move_by_regex
+import run_stats
+
+
+async def iter_source_matches(source, patterns, executor, index=None,
+                              stats=None):
+    """As move_by_regex.iter_source_matches, but asynchronous: yields the
+    same MatchEvents, in the same order, while directories are scanned on
+    executor.
+
+    source : str : path
+    patterns : list : lists
+        Patterns as for move_by_regex.search_source_for_patterns, or a
+        PatternSet
+    executor : concurrent.futures.Executor
+        Directories are scanned here, as many at once as it has threads
+    index : SourceIndex
+    stats : RunStats
+        As for move_by_regex.search_source_for_patterns
+    """
+    loop = asyncio.get_event_loop()
+    if not isinstance(patterns, move_by_regex.PatternSet):
+        patterns = await loop.run_in_executor(executor,
+                                              move_by_regex.PatternSet,
+                                              patterns, None, None, stats)
+    for p in patterns.invalid:
+        yield move_by_regex.MatchEvent('invalid_regex', p)
+    for r in patterns.redundant:
+        yield move_by_regex.MatchEvent('redundant', r)
+
+    def scan(root, nodes):
+        return root, loop.run_in_executor(executor,
+                                          move_by_regex.scan_directory,
+                                          root, nodes, index, stats)
+
+    # As in walk_source, each directory's subdirectories are scanned as soon
+    # as it has been, while results are taken in walk order.
+    anchors = await loop.run_in_executor(executor,
+                                         move_by_regex.literal_anchors,
+                                         source, patterns.trie)
+    stack = list(reversed([scan(root, nodes) for root, nodes in anchors]))
+    satisfied = set()
+    try:
+        while stack:
+            root, scanned = stack.pop()
+            dir_matches, file_matches, to_walk = await scanned
+            for event_type, matches in [('dir', dir_matches),
+                                        ('file', file_matches)]:
+                for name, pattern in matches:
+                    yield move_by_regex.MatchEvent(
+                        event_type, pattern,
+                        move_by_regex.swisspy.smooth_join(root, name))
+                    if id(pattern) not in satisfied:
+                        satisfied.add(id(pattern))
+                        yield move_by_regex.MatchEvent('satisfied', pattern)
+            children = [scan(os.path.join(root, name), below)
+                        for name, below in to_walk]
+            stack.extend(reversed(children))
+    finally:
+        for root, scanned in stack:
+            scanned.cancel()
+    for t in patterns.to_check:
+        if id(t) not in satisfied:
+            yield move_by_regex.MatchEvent('not_matched', t)
+
+
+async def search_source_for_patterns(source, patterns, workers=4,
+                                     index=None, stats=None, executor=None):
+    """As move_by_regex.search_source_for_patterns, but asynchronous.
+
+    workers : int : default 4
+        Number of threads to scan directories with, if executor isn't given
+    executor : concurrent.futures.Executor
+        If given, directories are scanned here instead
+
+    :return dict
+        As returned by move_by_regex.search_source_for_patterns
+    """
+    own_executor = executor is None
+    if own_executor:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    collector = move_by_regex.ResultCollector()
+    try:
+        async for event in iter_source_matches(source, patterns, executor,
+                                               index, stats):
+            collector.add(event)
+    finally:
+        if own_executor:
+            executor.shutdown(wait=True)
+    return collector.result
+
+
+async def move_source(source, dest, patterns, workers=4, moves=4,
+                      moves_per_device=1, queue_size=1000, stats=None,
+                      journal=None):
+    """Search source for patterns, moving everything found to dest as the
+    walk goes on - the asynchronous equivalent of a move_by_regex run.
+
+    source : str : path
+    dest : str : path
+    patterns : list : lists
+        As for search_source_for_patterns
+    workers : int : default 4
+        Number of threads to scan directories with
+    moves : int : default 4
+        The maximum number of moves to run at once
+    moves_per_device : int : default 1
+        The maximum number of moves to run at once onto any one device
+    queue_size : int : default 1000
+        The most matches to hold waiting to be moved before the walk pauses
+    stats : RunStats
+    journal : MoveJournal
+        As for move_by_regex.MoveExecutor
+
+    :return tuple
+        (records, search_result), where records are the MoveRecords for
+        everything found, in the order it was found, and search_result is as
+        returned by search_source_for_patterns
+    """
+    loop = asyncio.get_event_loop()
+    if stats is None:
+        stats = run_stats.RunStats()
+    walk_executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    move_executor = concurrent.futures.ThreadPoolExecutor(max_workers=moves)
+    mover = move_by_regex.MoveExecutor(source, dest, moves_per_device,
+                                       stats=stats, journal=journal)
+    pending = asyncio.Queue(maxsize=queue_size)
+    records = []
+    per_device = {}
+    collector = move_by_regex.ResultCollector()
+
+    # Moving as we go would feed moved items back into the walk
+    hold_back = move_by_regex.is_within(dest, source)
+
+    async def queue_move(event):
+        if event.type == 'dir':
+            moved_type = 'directories'
+        else:
+            moved_type = 'files'
+        record = await loop.run_in_executor(move_executor, mover.plan,
+                                            event.path, moved_type)
+        records.append(record)
+        await pending.put(record)
+
+    async def walk():
+        events = iter_source_matches(source, patterns, walk_executor,
+                                     stats=stats)
+        held = []
+        try:
+            async for event in events:
+                collector.add(event)
+                if event.type in ['dir', 'file']:
+                    if hold_back:
+                        held.append(event)
+                    else:
+                        await queue_move(event)
+        finally:
+            await events.aclose()
+        for event in held:
+            await queue_move(event)
+        for i in range(moves):
+            await pending.put(None)
+
+    async def move():
+        while True:
+            record = await pending.get()
+            if record is None:
+                return
+            device = await loop.run_in_executor(move_executor,
+                                                mover.destination_device,
+                                                record.to_move)
+            if device not in per_device:
+                per_device[device] = asyncio.Semaphore(moves_per_device)
+            async with per_device[device]:
+                moving = loop.run_in_executor(move_executor, mover.move,
+                                              record)
+                try:
+                    await asyncio.shield(moving)
+                except asyncio.CancelledError:
+                    # Let a move already under way finish before stopping
+                    await moving
+                    raise
+
+    tasks = [asyncio.ensure_future(walk())]
+    tasks.extend(asyncio.ensure_future(move()) for i in range(moves))
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    finally:
+        walk_executor.shutdown(wait=True)
+        move_executor.shutdown(wait=True)
+    return records, collector.result
@@ -0,0 +1,159 @@
+"""Copies files and directory trees between devices as quickly as the
+platform allows, for moves which can't be done with a rename.
+
+Each file's data is copied by the kernel where possible - copy_file_range,
+then sendfile - and otherwise through a large page-aligned buffer. Metadata
+is copied with a single copystat per item once its data is in place, and
+directories get theirs after everything in them has been copied, so their
+modification times survive.
+"""
+
+import errno
+import io
+import mmap
+import os
+import shutil
+import stat
+
+# Size of the buffer used when the kernel can't copy for us, and of each
+# request made when it can.
+COPY_BUFFER = 8 * 1024 * 1024
+
+# Errors meaning a kernel copy isn't supported between these two files, so
+# the next method should be tried.
+UNSUPPORTED = set(getattr(errno, name) for name in
+                  ['ENOSYS', 'EXDEV', 'EINVAL', 'EOPNOTSUPP', 'ENOTSUP',
+                   'ENOTSOCK', 'EBADF']
+                  if hasattr(errno, name))
+
+class CopyError(shutil.Error):
+    """Raised when a copy doesn't hold as many bytes as its source, or
+    something in it can't be copied."""
+    pass
+
+def kernel_copy(copy, src_fd, dst_fd, size):
+    """Copy size bytes between two file descriptors with copy, which is
+    called as copy(src_fd, dst_fd, offset, count) and returns the number of
+    bytes it copied. Returns the number of bytes copied in all, or None if
+    copy isn't supported for these files and nothing has been copied."""
+    offset = 0
+    while offset < size:
+        try:
+            copied = copy(src_fd, dst_fd, offset, min(COPY_BUFFER,
+                                                      size - offset))
+        except OSError as e:
+            if offset == 0 and e.errno in UNSUPPORTED:
+                return None
+            raise
+        if not copied:
+            break
+        offset += copied
+    return offset
+
+def copy_file_range(src_fd, dst_fd, offset, count):
+    return os.copy_file_range(src_fd, dst_fd, count, offset, offset)
+
+def sendfile(src_fd, dst_fd, offset, count):
+    return os.sendfile(dst_fd, src_fd, offset, count)
+
+try:
+    buffer
+except NameError:
+    def window(buf, n):
+        """Return the first n bytes of buf, without copying them."""
+        return memoryview(buf)[:n]
+else:
+    # Python 2's mmap only has the old buffer interface
+    def window(buf, n):
+        """Return the first n bytes of buf, without copying them."""
+        return buffer(buf, 0, n)
+
+def buffered_copy(src_file, dst_file):
+    """Copy between two unbuffered file objects through a page-aligned
+    buffer. Returns the number of bytes copied."""
+    buf = mmap.mmap(-1, COPY_BUFFER)
+    copied = 0
+    try:
+        while True:
+            n = src_file.readinto(buf)
+            if not n:
+                break
+            dst_file.write(window(buf, n))
+            copied += n
+    finally:
+        buf.close()
+    return copied
+
+def copy_file(src, dst):
+    """Copy the contents and metadata of the regular file src to dst.
+    Returns the number of bytes copied."""
+    with io.open(src, 'rb', buffering=0) as src_file:
+        with io.open(dst, 'wb', buffering=0) as dst_file:
+            src_fd = src_file.fileno()
+            dst_fd = dst_file.fileno()
+            size = os.fstat(src_fd).st_size
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(src_fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            copied = None
+            for method, available in [(copy_file_range,
+                                       hasattr(os, 'copy_file_range')),
+                                      (sendfile, hasattr(os, 'sendfile'))]:
+                if available and size:
+                    copied = kernel_copy(method, src_fd, dst_fd, size)
+                    if copied is not None:
+                        break
+            if copied is None:
+                copied = buffered_copy(src_file, dst_file)
+            elif copied < size:
+                # The file grew or the kernel stopped short; carry on from
+                # where it got to.
+                src_file.seek(copied)
+                dst_file.seek(copied)
+                copied += buffered_copy(src_file, dst_file)
+    shutil.copystat(src, dst)
+    return copied
+
+def copy_tree(src, dst):
+    """Copy a file, symlink or directory tree to dst, which must not exist.
+    Symlinks are copied as links, not followed, and FIFOs are made afresh.
+    Returns the number of bytes of file data copied.
+
+    Raises CopyError, rather than opening it, for a socket or device file:
+    reading one could block for ever, and what it yields isn't its
+    contents."""
+    mode = os.lstat(src).st_mode
+    if stat.S_ISLNK(mode):
+        os.symlink(os.readlink(src), dst)
+        return 0
+    if stat.S_ISFIFO(mode):
+        os.mkfifo(dst)
+        shutil.copystat(src, dst)
+        return 0
+    if stat.S_ISREG(mode):
+        return copy_file(src, dst)
+    if not stat.S_ISDIR(mode):
+        raise CopyError("{} is a socket or device file, so can't be "
+                        "copied".format(src))
+    copied = 0
+    os.mkdir(dst)
+    for name in os.listdir(src):
+        copied += copy_tree(os.path.join(src, name), os.path.join(dst, name))
+    shutil.copystat(src, dst)
+    return copied
+
+def content_size(path):
+    """Return the number of bytes held in a file, or in all the files under
+    a directory, not following symlinks. Directories' own sizes are left
+    out, as they differ from one filesystem to another."""
+    st = os.lstat(path)
+    if stat.S_ISREG(st.st_mode):
+        return st.st_size
+    if not stat.S_ISDIR(st.st_mode):
+        return 0
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            st = os.lstat(os.path.join(root, name))
+            if stat.S_ISREG(st.st_mode):
+                size += st.st_size
+    return size
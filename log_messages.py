@@ -13,6 +13,26 @@ class LogMessage:
         found_files_header = "{type} found:"
         unmatched_header = "The following patterns were not matched:"
         no_patterns = "No patterns entered in {path_file}; nothing to do."
+        stats_header = "Timings and counts for this run:"
+        plan_written = "The search result was written to {plan_file}; " \
+                       "nothing was moved."
+        applying_plan = "Moving the items listed in {plan_file}; source " \
+                        "was not searched."
+        batch_patterns = "Patterns read from {path_file}:"
+        patterns_read = "Patterns read from {path_file}: {count} " \
+                        "(SHA-1 {digest})"
+        patterns_cached = "Patterns read from the cache for {path_file}: " \
+                          "{count} (SHA-1 {digest})"
+        batch_job = "Job {n}: moving from {source} to {dest}"
+        batch_job_failed = "The job moving from {source} failed:"
+        batch_job_stats_header = "Timings and counts for {source} -> {dest}:"
+        batch_stats_header = "Timings and counts for all {jobs} jobs:"
+        watching = "Watching {source} for new matches, checking for " \
+                   "changes at least every {interval} seconds."
+        watch_found = "Found {path}"
+        watch_stopped = "Stopped watching {source}."
+        resuming = "Resuming the moves journalled in {journal_file}; " \
+                   "source was not searched again."
 
         self.header = header
         self.success_story = success_story
@@ -20,3 +40,17 @@ class LogMessage:
         self.found_files_header = found_files_header
         self.unmatched_header = unmatched_header
         self.no_patterns = no_patterns
+        self.stats_header = stats_header
+        self.resuming = resuming
+        self.batch_patterns = batch_patterns
+        self.batch_job = batch_job
+        self.batch_job_failed = batch_job_failed
+        self.batch_job_stats_header = batch_job_stats_header
+        self.batch_stats_header = batch_stats_header
+        self.plan_written = plan_written
+        self.applying_plan = applying_plan
+        self.patterns_read = patterns_read
+        self.patterns_cached = patterns_cached
+        self.watching = watching
+        self.watch_found = watch_found
+        self.watch_stopped = watch_stopped
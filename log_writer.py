@@ -0,0 +1,136 @@
+"""A logging handler which writes to a file from a background thread, in
+batches, so that logging every path moved never holds up the threads doing
+the moving - however slow the share the log is kept on.
+
+Records are formatted as they are logged and added to a buffer, which the
+writer thread writes out whenever FLUSH_BYTES are waiting, and otherwise
+every FLUSH_SECONDS. Logging a record costs a list append, whatever the
+log file is on. A log file whose name ends '.gz' is gzip compressed as it
+is written. Whatever is still buffered is written when the handler is
+flushed or closed, which the logging module does for every handler when the
+interpreter exits.
+"""
+
+import gzip
+import logging
+import os
+import threading
+import traceback
+
+# Write once this many bytes of records are waiting...
+FLUSH_BYTES = 64 * 1024
+
+# ...and otherwise this often, in seconds
+FLUSH_SECONDS = 1.0
+
+# Python 2's files want bytes, so unicode records are encoded first
+TEXT_IS_BYTES = str is bytes
+
+class BufferedFileHandler(logging.Handler):
+    """Like logging.FileHandler, but emit only buffers each formatted record
+    for a writer thread. Once closed, the next record logged opens the file
+    again, as FileHandler does.
+    """
+    def __init__(self, filename, mode='a', compress=None,
+                 flush_bytes=FLUSH_BYTES, flush_seconds=FLUSH_SECONDS):
+        """
+        filename : str : path
+            The log file
+        mode : str : default 'a'
+            'a' to append to the log file, 'w' to start it afresh
+        compress : bool
+            Whether to gzip the log file. By default, it is gzipped if its
+            name ends '.gz'
+        flush_bytes : int : default FLUSH_BYTES
+        flush_seconds : float : default FLUSH_SECONDS
+            Buffered records are written once this many bytes are waiting,
+            and otherwise this often
+        """
+        logging.Handler.__init__(self)
+        self.baseFilename = os.path.abspath(filename)
+        self.mode = mode
+        if compress is None:
+            compress = filename.endswith('.gz')
+        self.compress = compress
+        self.flush_bytes = flush_bytes
+        self.flush_seconds = flush_seconds
+        self.waiting = []
+        self.waiting_bytes = 0
+        # Held while adding to or taking the buffer...
+        self.buffer_lock = threading.Lock()
+        # ...and while writing it, so batches go out in order
+        self.write_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopping = False
+        self.stream = None
+        self.writer = None
+
+    def start(self):
+        """Open the log file and start the writer thread."""
+        if self.compress:
+            self.stream = gzip.open(self.baseFilename, self.mode + 't')
+        else:
+            self.stream = open(self.baseFilename, self.mode)
+        self.stopping = False
+        self.writer = threading.Thread(target=self.run)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def emit(self, record):
+        try:
+            message = self.format(record)
+            if TEXT_IS_BYTES and not isinstance(message, str):
+                message = message.encode('utf-8')
+            # Called with the handler's lock held, so only one thread
+            # ever starts the writer
+            if self.writer is None:
+                self.start()
+            with self.buffer_lock:
+                self.waiting.append(message)
+                self.waiting_bytes += len(message) + 1
+                full = self.waiting_bytes >= self.flush_bytes
+            if full:
+                self.wake.set()
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except Exception:
+            self.handleError(record)
+
+    def run(self):
+        while not self.stopping:
+            self.wake.wait(self.flush_seconds)
+            self.wake.clear()
+            self.flush()
+
+    def flush(self):
+        """Write out everything logged so far."""
+        with self.write_lock:
+            with self.buffer_lock:
+                messages = self.waiting
+                self.waiting = []
+                self.waiting_bytes = 0
+            if not messages or self.stream is None:
+                return
+            try:
+                self.stream.write("\n".join(messages) + "\n")
+                self.stream.flush()
+            except (IOError, OSError, ValueError):
+                if logging.raiseExceptions:
+                    traceback.print_exc()
+
+    def close(self):
+        """Write out everything still buffered, and close the log file."""
+        self.acquire()
+        try:
+            if self.writer is not None:
+                self.stopping = True
+                self.wake.set()
+                self.writer.join()
+                self.writer = None
+                self.flush()
+                with self.write_lock:
+                    self.stream.close()
+                    self.stream = None
+        finally:
+            self.release()
+        logging.Handler.close(self)
@@ -1,12 +1,101 @@
 #!/usr/bin/env python2.7
 
 import argparse
+import importlib
 import os
 import swisspy
-import shutil
-import logging
 import log_messages
 import re
+import signal
+import stat
+import errno
+import sys
+import time
+
+class LazyModule:
+    """Stands in for a module which isn't imported until one of its
+    attributes is first used, so that runs which end early - --help, or an
+    empty pattern file - don't pay to import everything. Given several
+    names, the first which can be imported is used.
+
+    >>> json = LazyModule('json')
+    >>> json.dumps([1])
+    '[1]'
+    """
+    def __init__(self, *names):
+        self.names = names
+        self.module = None
+
+    def __getattr__(self, attr):
+        if self.module is None:
+            for name in self.names[:-1]:
+                try:
+                    self.module = importlib.import_module(name)
+                    break
+                except ImportError:
+                    pass
+            else:
+                self.module = importlib.import_module(self.names[-1])
+        return getattr(self.module, attr)
+
+array = LazyModule('array')
+copy_engine = LazyModule('copy_engine')
+gzip = LazyModule('gzip')
+hashlib = LazyModule('hashlib')
+logging = LazyModule('logging')
+log_writer = LazyModule('log_writer')
+marshal = LazyModule('marshal')
+multiprocessing = LazyModule('multiprocessing')
+pattern_cache = LazyModule('pattern_cache')
+move_journal = LazyModule('move_journal')
+queue = LazyModule('queue', 'Queue')
+run_stats = LazyModule('run_stats')
+shutil = LazyModule('shutil')
+source_index = LazyModule('source_index')
+source_watch = LazyModule('source_watch')
+tempfile = LazyModule('tempfile')
+threading = LazyModule('threading')
+
+try:
+    intern
+except NameError:
+    from sys import intern
+
+try:
+    from os import scandir
+except ImportError:
+    # Python 2 only has scandir as a backport; without it we fall back to
+    # os.listdir and a stat per entry.
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# Directories whose live patterns only hold up to this many literal names
+# are probed with a stat per name rather than listed.
+LITERAL_PROBE_LIMIT = 32
+
+# Regexes are combined into chunks of at most this many, as Python 2's re
+# module can't compile a pattern with more than 100 groups.
+COMBINE_GROUPS = 99
+
+# Directory entries are sent to a MatchPool in batches of up to this many
+# names. Each listing is split between all of the pool's processes, so
+# batches are smaller than this unless the listing is very large.
+MATCH_BATCH = 2000
+
+# Listings of fewer names than this are matched in the walking process, as
+# sending them to a MatchPool costs more than matching them.
+POOL_MIN_NAMES = 64
+
+# With several workers, walk_source has up to this many directories per
+# worker listed, or being listed, ahead of the one it is visiting; beyond
+# that, the workers wait for it to catch up.
+SCAN_AHEAD = 4
+
+# Each device's queue of moves holds up to this many items; beyond that,
+# the walk waits for moves to catch up.
+MOVE_QUEUE_SIZE = 1000
 
 class PatternPiece:
     """Part of a pattern, which itself is a divided path.
@@ -48,6 +137,11 @@ class PatternPiece:
         'regex'
         >>> q.regex_pattern
         '[Ww]hee+'
+        >>> q.regex.match('wheeee') is not None
+        True
+
+        >>> PatternPiece('regex{[unclosed}').regex is None
+        True
 
         """
         self.name = name
@@ -55,17 +149,283 @@ class PatternPiece:
         self.regex_ind_end = regex_ind_end
         self.glob_pattern = glob_pattern
         self.regex_pattern = None
+        self.regex = None
 
         if self.name[:len(self.regex_ind_start)] == self.regex_ind_start and \
            self.name[-len(self.regex_ind_end):] == self.regex_ind_end:
             self.type = 'regex'
             regex_pattern = self.name[len(regex_ind_start):-len(regex_ind_end)]
             self.regex_pattern = regex_pattern
+            # Compiled once here, so matching never has to parse it. If it
+            # won't compile, self.regex stays None and the pattern holding
+            # this piece is rejected by compile_patterns.
+            try:
+                self.regex = re.compile(regex_pattern)
+            except re.error:
+                pass
         elif self.name == self.glob_pattern:
             self.type = 'glob'
         else:
             self.type = 'string'
 
+class CompiledPattern(list):
+    """A split pattern, as returned by get_patterns, which also carries the
+    PatternPiece for each of its levels. Built once when patterns are loaded,
+    so nothing downstream has to parse a piece again. Compares equal to the
+    plain list it was made from.
+
+      CompiledPattern.pieces        : list of PatternPiece objects
+      CompiledPattern.invalid_regex : regex patterns in this pattern which
+                                      failed to compile
+      CompiledPattern.is_literal    : True if every piece is a plain string
+
+    >>> c = CompiledPattern(['tmp', '*', 'regex{[0-9]+}'])
+    >>> c == ['tmp', '*', 'regex{[0-9]+}']
+    True
+    >>> [piece.type for piece in c.pieces]
+    ['string', 'glob', 'regex']
+    >>> c.is_literal
+    False
+    >>> CompiledPattern(['tmp', 'regex{(}']).invalid_regex
+    ['(']
+    """
+    def __init__(self, pattern,
+                 regex_ind_start="regex{",
+                 regex_ind_end="}",
+                 shared_pieces=None):
+        """
+        shared_pieces : dict
+            If given, PatternPieces are looked up here by name, and added to
+            it when missing, so that patterns sharing a piece share the one
+            object. Must only be used with one pair of regex indicators.
+        """
+        list.__init__(self, pattern)
+        if shared_pieces is None:
+            self.pieces = [PatternPiece(p,
+                                        regex_ind_start=regex_ind_start,
+                                        regex_ind_end=regex_ind_end)
+                           for p in pattern]
+        else:
+            self.pieces = []
+            for p in pattern:
+                piece = shared_pieces.get(p)
+                if piece is None:
+                    piece = PatternPiece(p, regex_ind_start=regex_ind_start,
+                                         regex_ind_end=regex_ind_end)
+                    shared_pieces[p] = piece
+                self.pieces.append(piece)
+        self.invalid_regex = [p.regex_pattern for p in self.pieces
+                              if p.type == 'regex' and p.regex is None]
+        self.is_literal = all(p.type == 'string' for p in self.pieces)
+
+def compile_patterns(patterns, regex_ind_start=None, regex_ind_end=None):
+    """Return a list of CompiledPattern objects for a list of patterns.
+    Patterns which are already compiled are passed through untouched.
+
+    patterns : list : lists
+        Patterns, as returned by get_patterns
+    regex_ind_start : str : default 'regex{'
+    regex_ind_end : str : default '}'
+        Strings indicating the beginning and end of a regex pattern
+
+    >>> compiled = compile_patterns([['tmp', 'gog']])
+    >>> compiled[0].pieces[1].name
+    'gog'
+    >>> compile_patterns(compiled)[0] is compiled[0]
+    True
+    """
+    if regex_ind_start is None:
+        regex_ind_start = "regex{"
+    if regex_ind_end is None:
+        regex_ind_end = "}"
+    compiled = []
+    for p in patterns:
+        if not isinstance(p, CompiledPattern):
+            p = CompiledPattern(p, regex_ind_start, regex_ind_end)
+        compiled.append(p)
+    return compiled
+
+def can_combine(regex):
+    """Return True if a compiled regex can be merged into a CombinedRegex:
+    it mustn't have groups of its own, which would throw off the numbering,
+    or any (?...) extension other than a plain (?:...), as inline flags would
+    apply to the whole combined pattern.
+
+    >>> can_combine(re.compile('4[0-9]{5}$'))
+    True
+    >>> can_combine(re.compile('(?:a|b)_c'))
+    True
+    >>> can_combine(re.compile('(a|b)_c'))
+    False
+    >>> can_combine(re.compile('(?i)video'))
+    False
+    """
+    return regex.groups == 0 and '(?' not in regex.pattern.replace('(?:', '')
+
+class CombinedRegex:
+    """Tests a name against a list of regexes at once. Each regex is wrapped
+    in an optional lookahead, so a single match of the combined pattern at
+    the start of the name tries every one of them, and the group belonging
+    to each one that matched is set. Regexes which can't be combined (see
+    can_combine) are still tried one at a time.
+
+      CombinedRegex.evaluations : the number of regex matches run for each
+                                  name tested
+
+    >>> combined = CombinedRegex([re.compile('a'), re.compile('[a-c]x'),
+    ...                           re.compile('(b)x'), re.compile('.*y$')])
+    >>> combined.matching('bx')
+    [1, 2]
+    >>> combined.matching('ax')
+    [0, 1]
+    >>> combined.matching('zzy')
+    [3]
+    >>> combined.evaluations
+    2
+    """
+    def __init__(self, regexes):
+        """
+        regexes : list : compiled regexes
+        """
+        combinable = []
+        self.separate = []
+        for i, regex in enumerate(regexes):
+            if can_combine(regex):
+                combinable.append(i)
+            else:
+                self.separate.append((i, regex))
+        self.chunks = []
+        for start in range(0, len(combinable), COMBINE_GROUPS):
+            indices = combinable[start:start + COMBINE_GROUPS]
+            if len(indices) == 1:
+                self.separate.append((indices[0], regexes[indices[0]]))
+                continue
+            combined = ''.join('(?:(?=(%s)))?' % regexes[i].pattern
+                               for i in indices)
+            self.chunks.append((re.compile(combined), indices))
+        self.separate.sort()
+        self.evaluations = len(self.chunks) + len(self.separate)
+
+    def matching(self, name):
+        """Return, in order, the indices of the regexes matching name."""
+        matched = []
+        for combined, indices in self.chunks:
+            groups = combined.match(name).groups()
+            matched.extend(indices[k] for k, group in enumerate(groups)
+                           if group is not None)
+        for i, regex in self.separate:
+            if regex.match(name):
+                matched.append(i)
+        if self.chunks and self.separate:
+            matched.sort()
+        return matched
+
+class PatternTrie:
+    """A prefix tree of patterns, keyed by path level, so that each entry in a
+    directory need only be looked up once per live node rather than once per
+    pattern. Each node holds the pieces which may follow it, split by type:
+
+      PatternTrie.literals : dict mapping a string piece to the node below it
+      PatternTrie.glob     : the node below a glob piece, or None
+      PatternTrie.regexes  : list of (PatternPiece, node) pairs
+      PatternTrie.pattern  : the pattern ending at this node, or None
+
+    The regex pieces at each node are matched together by a CombinedRegex,
+    built when the node is first matched against.
+    """
+    def __init__(self, patterns=None):
+        """
+        patterns : list : lists
+            Patterns to add to the trie, as returned by get_patterns or
+            compile_patterns
+
+        >>> trie = PatternTrie([['tmp', '*'], ['usr', 'regex{b.n}']])
+        >>> sorted(trie.literals.keys())
+        ['tmp', 'usr']
+        >>> tmp = trie.children_matching('tmp')[0]
+        >>> tmp.pattern is None
+        True
+        >>> tmp.children_matching('gog')[0].pattern
+        ['tmp', '*']
+        >>> trie.children_matching('usr')[0].children_matching('bin')[0].pattern
+        ['usr', 'regex{b.n}']
+        >>> trie.children_matching('var')
+        []
+        """
+        self.literals = {}
+        self.glob = None
+        self.regexes = []
+        self.pattern = None
+        self.matcher = None
+        if patterns:
+            for p in compile_patterns(patterns):
+                self.add(p)
+
+    def add(self, pattern):
+        """Add a CompiledPattern to the trie, sharing nodes with any patterns
+        which begin with the same pieces. Returns the node it ends at."""
+        node = self
+        for piece in pattern.pieces:
+            if piece.type == 'glob':
+                if node.glob is None:
+                    node.glob = PatternTrie()
+                node = node.glob
+            elif piece.type == 'regex':
+                for existing, child in node.regexes:
+                    if existing.name == piece.name:
+                        node = child
+                        break
+                else:
+                    child = PatternTrie()
+                    node.regexes.append((piece, child))
+                    node.matcher = None
+                    node = child
+            else:
+                child = node.literals.get(piece.name)
+                if child is None:
+                    child = PatternTrie()
+                    node.literals[piece.name] = child
+                node = child
+        if node.pattern is None:
+            node.pattern = pattern
+        return node
+
+    def children_matching(self, name):
+        """Return a list of the nodes directly below this one whose pieces
+        match name.
+
+        name : str
+            The name of a directory entry
+        """
+        children = []
+        literal = self.literals.get(name)
+        if literal is not None:
+            children.append(literal)
+        if self.glob is not None:
+            children.append(self.glob)
+        if self.regexes:
+            for i in self.regex_matcher().matching(name):
+                children.append(self.regexes[i][1])
+        return children
+
+    def regex_matcher(self):
+        """Return the CombinedRegex for this node's regex pieces, building
+        it the first time it is asked for."""
+        if self.matcher is None:
+            self.matcher = CombinedRegex([piece.regex for piece, child
+                                          in self.regexes])
+        return self.matcher
+
+    def children_covering(self, name):
+        """As children_matching, but for a piece of another pattern rather
+        than a directory entry: a regex piece also covers an identical one.
+        """
+        children = self.children_matching(name)
+        for piece, child in self.regexes:
+            if piece.name == name and child not in children:
+                children.append(child)
+        return children
+
 def init_args(current_dir):
     """ Initialise command line arguments"""
     p = argparse.ArgumentParser(
@@ -79,17 +439,87 @@ def init_args(current_dir):
                    help="The destination")
     p.add_argument('-p', '--paths-file', metavar='path', type=str,
                    dest='paths_file',
-                   help="Path to a file containing patterns to be moved")
+                   help="Path to a file containing patterns to be moved, "\
+                        "which may be gzipped, or - to read standard input")
     p.add_argument('-l', '--log-file', metavar='path', type=str,
                    dest='log_file',
-                   help="Path to log file")
+                   help="Path to log file, which is gzipped if it ends "\
+                        ".gz")
+    p.add_argument('-v', '--verbose', action='store_true', default=False,
+                   dest='verbose',
+                   help="Log every pattern read, rather than just how many "\
+                        "there were")
     p.add_argument('-r', '--read-only', action='store_true', default=False,
                    dest='read_only',
                    help="Run in read only mode - log but don't move.")
     p.add_argument('--log-unmatched', action='store_true', default=False,
                    dest='log_unmatched',
                    help="Log any paths which were not found in source")
-    return p.parse_args()
+    p.add_argument('-w', '--workers', metavar='N', type=int, default=1,
+                   dest='workers',
+                   help="Number of threads to search source with")
+    p.add_argument('--moves-per-device', metavar='N', type=int, default=1,
+                   dest='moves_per_device',
+                   help="Number of moves to run at once onto each "\
+                        "destination device")
+    p.add_argument('--match-processes', metavar='N', type=int, default=1,
+                   dest='match_processes',
+                   help="Number of processes to match regex patterns with")
+    p.add_argument('--pattern-cache', metavar='path', type=str,
+                   default=None, dest='pattern_cache_dir',
+                   help="Directory to cache checked patterns in, so later "\
+                        "runs with an unchanged paths file start faster")
+    p.add_argument('--index', metavar='path', type=str, default=None,
+                   dest='index_file',
+                   help="SQLite file to keep an index of source in, so "\
+                        "later runs only re-list directories which changed")
+    p.add_argument('-j', '--journal', metavar='path', type=str,
+                   default=None, dest='journal_file',
+                   help="Journal the progress of each move to this file")
+    p.add_argument('--resume', action='store_true', default=False,
+                   dest='resume',
+                   help="Carry on from an interrupted run's journal, given "\
+                        "with --journal, instead of starting afresh")
+    p.add_argument('--plan-out', metavar='path', type=str, default=None,
+                   dest='plan_file',
+                   help="Search source and write what would be moved to "\
+                        "this file, without moving anything")
+    p.add_argument('--apply', metavar='path', type=str, default=None,
+                   dest='apply_file',
+                   help="Move exactly what is listed in a file written by "\
+                        "--plan-out, without searching. With -r, only log "\
+                        "what would be moved.")
+    p.add_argument('-b', '--batch', metavar='path', type=str, default=None,
+                   dest='batch_file',
+                   help="Run every job in this manifest, one per line as "\
+                        "source, dest and optionally a paths file, "\
+                        "separated by tabs. -s and -d are ignored.")
+    p.add_argument('--watch', metavar='seconds', type=float, default=None,
+                   dest='watch_interval',
+                   help="Once source has been searched, keep watching it "\
+                        "and move new matches as they appear, checking "\
+                        "for changes this often")
+    p.add_argument('--stats', action='store_true', default=False,
+                   dest='stats',
+                   help="Print a table of timings and counts when done")
+    p.add_argument('--stats-json', metavar='path', type=str, default=None,
+                   dest='stats_file',
+                   help="Write timings and counts to this file as JSON")
+    args = p.parse_args()
+    if args.resume and not args.journal_file:
+        p.error("--resume needs a journal, given with --journal")
+    if args.plan_file and args.apply_file:
+        p.error("--plan-out and --apply can't be used together")
+    if args.batch_file and (args.index_file or args.journal_file or
+                            args.plan_file or args.apply_file):
+        p.error("--batch can't be used with --index, --journal, "\
+                "--plan-out or --apply")
+    if args.watch_interval is not None and \
+       (args.batch_file or args.index_file or args.journal_file or
+        args.plan_file or args.apply_file):
+        p.error("--watch can't be used with --batch, --index, --journal, "\
+                "--plan-out or --apply")
+    return args
 
 def init_console_logging():
     """Currently not implemented."""
@@ -107,27 +537,38 @@ def init_logging(log_file, log_text):
     Excellent explanation of how this works here:
     https://docs.python.org/2/howto/logging-cookbook.html
 
+    Records are written to log_file in batches by a background thread (see
+    log_writer), so logging never holds up a move.
+
     log_file : str : path
-        Path to the human readable log
+        Path to the human readable log. Gzipped if it ends '.gz'.
     log_text : LogMessage object
         Object read from log_messages.py
     """
     log_file = os.path.abspath(log_file)
-    # Set up logging to file
-    logging.basicConfig(level=logging.INFO,
-                        format='%(message)s',
-                        datefmt='%m/%d/%Y %H:%M',
-                        filename=log_file,
-                        filemode='w')
+    # Set up logging to file, as logging.basicConfig would
+    root_logger = logging.getLogger()
+    if not root_logger.handlers:
+        to_file = log_writer.BufferedFileHandler(log_file, 'w')
+        to_file.setFormatter(logging.Formatter('%(message)s',
+                                               '%m/%d/%Y %H:%M'))
+        root_logger.addHandler(to_file)
+        root_logger.setLevel(logging.INFO)
     init_logger = logging.getLogger('mbr.loginit')
     init_logger.info(log_text.header)
 
+def flush_logging():
+    """Wait for everything logged so far to be written to the log file."""
+    for handler in logging.getLogger().handlers:
+        handler.flush()
+
 def get_lines(from_path, get_comments=False, comment_char='#'):
     """Parse a file and return a list of strings, ignoring comments if
     requested.
 
     from_path : path
-        The path to the file to be parsed.
+        The path to the file to be parsed, '-' for standard input, or a
+        path ending '.gz' for a gzip compressed file
     get_comments : bool
         If False, ignore lines starting with comment_char
         Default: False
@@ -135,13 +576,74 @@ def get_lines(from_path, get_comments=False, comment_char='#'):
         Character denoting comment lines
         Default : '#'
     """
-    the_file = os.path.abspath(from_path)
-    with open(the_file, 'r') as f:
-        if get_comments:
-            out_list = [line.strip() for line in f]
+    return list(iter_lines(from_path, get_comments, comment_char))
+
+def iter_lines(from_path, get_comments=False, comment_char='#'):
+    """As get_lines, but yield each line as it is read rather than reading
+    the whole file first."""
+    if from_path == '-':
+        f = sys.stdin
+    elif from_path.endswith('.gz'):
+        f = gzip.open(os.path.abspath(from_path), 'rt')
+    else:
+        f = open(os.path.abspath(from_path), 'r')
+    try:
+        for line in f:
+            if get_comments or line[0] != comment_char:
+                yield line.strip()
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def read_patterns(paths_file, regex_ind_start="regex{", regex_ind_end="}",
+                  logger=None, trie=None):
+    """Read the patterns in paths_file a line at a time, compiling each one
+    straight into a PatternTrie and leaving out blank lines and any pattern
+    already read. A repeat is told by the trie node it ends at already
+    holding a pattern, so no line is kept once it has been compiled; only
+    the compiled patterns are. Patterns with a regex which won't compile are
+    left out of the trie.
+
+    paths_file : str : path
+        As for get_lines
+    logger : logging.Logger
+        If given, each pattern is logged here as it is read
+    trie : PatternTrie
+        The trie to add patterns to, which can be handed on to PatternSet
+        so it needn't build another to find redundant patterns. Must start
+        out empty. By default a trie is made just for reading.
+
+    :return tuple
+        (patterns, digest), where patterns is a list of CompiledPatterns and
+        digest is a SHA-1 hex digest of their lines, in the order read, for
+        telling from the log whether two runs looked for the same patterns
+    """
+    if trie is None:
+        trie = PatternTrie()
+    patterns = []
+    invalid = set()
+    shared_pieces = {}
+    digest = hashlib.sha1()
+    for line in iter_lines(paths_file):
+        if not line:
+            continue
+        pattern = CompiledPattern(split_path(line), regex_ind_start,
+                                  regex_ind_end, shared_pieces)
+        if pattern.invalid_regex:
+            # Never searched for, so kept out of the trie; these are few
+            if tuple(pattern) in invalid:
+                continue
+            invalid.add(tuple(pattern))
+        elif trie.add(pattern).pattern is not pattern:
+            continue
+        if logger is not None:
+            logger.info(line)
+        if isinstance(line, bytes):
+            digest.update(line + b"\n")
         else:
-            out_list = [line.strip() for line in f if line[0] != comment_char]
-    return out_list
+            digest.update(line.encode('utf-8') + b"\n")
+        patterns.append(pattern)
+    return patterns, digest.hexdigest()
 
 def split_path(path):
     """Given a path, this will split it into a list where each component is
@@ -222,54 +724,686 @@ def match(match_to, input):
     """
     matches=False
     if match_to.type == 'regex':
-        if re.match(match_to.regex_pattern, input):
+        if match_to.regex.match(input):
             matches = True
     else:
         if input == match_to.name or match_to.type == 'glob':
             matches = True
     return matches
 
-def get_redundant_patterns(from_list):
+def pattern_covers(p, c):
+    """Return True if every path matching CompiledPattern c lies at or below
+    a path matching CompiledPattern p. Each of p's pieces must match, or be
+    identical to, c's piece at the same depth.
+
+    >>> pattern_covers(CompiledPattern(['a', '*']), CompiledPattern(['a', 'b']))
+    True
+    >>> pattern_covers(CompiledPattern(['a', 'b']), CompiledPattern(['a', '*']))
+    False
+    >>> pattern_covers(CompiledPattern(['regex{[ab]}']),
+    ...                CompiledPattern(['regex{[ab]}', 'c']))
+    True
+    """
+    if len(p) > len(c):
+        return False
+    for depth in range(0, len(p)):
+        # Using p's PatternPiece allows us to use match, which handles globs
+        # and regex gracefully
+        if p.pieces[depth].name != c[depth] and \
+           not match(p.pieces[depth], c[depth]):
+            return False
+    return True
+
+def get_redundant_patterns(from_list, trie=None):
     """
+    Split a list of patterns into those which need to be searched for, and
+    those which are redundant because a shorter pattern already covers them.
+    Raw patterns are compiled first; the lists returned hold CompiledPattern
+    objects, each sorted by length.
+
+    Every pattern is put in a PatternTrie, which each pattern is then walked
+    down to find any others covering it, so the cost grows with the number of
+    patterns rather than its square. Of two patterns which cover each other,
+    the first is kept.
+
+    trie : PatternTrie
+        If given, a trie already holding every pattern in from_list, each
+        ending at a node of its own - as filled in by read_patterns - to use
+        rather than building another
+
     >>> get_redundant_patterns([['a','b','c'], ['a','b']])
     {'not_redundant': [['a', 'b']], 'redundant': [['a', 'b', 'c']]}
     >>> get_redundant_patterns([['a','*'], ['a','b'], ['a','c','f']])
     {'not_redundant': [['a', '*']], 'redundant': [['a', 'b'], ['a', 'c', 'f']]}
+    >>> get_redundant_patterns([['a','b'], ['a','*'], ['a','b']])
+    {'not_redundant': [['a', '*']], 'redundant': [['a', 'b'], ['a', 'b']]}
 
     """
     redundant = []
-    not_redundant = sorted(from_list[:], key=len)
-    for p in not_redundant:
-        candidates = [n for n in not_redundant if len(n) >= len(p) if n != p]
-        for c in candidates:
-            # Guilty until proven innocent
-            p_and_c_distinct = False
-            for depth in range(0, len(p)):
-                # Conversion to PatternPiece here allows us to use match,
-                # which handles globs and regex gracefully
-                p_piece = PatternPiece(p[depth])
-                if not match(p_piece, c[depth]):
-                    p_and_c_distinct = True
-            if not p_and_c_distinct:
-                redundant.append(c)
-                not_redundant.remove(c)
+    not_redundant = []
+    patterns = sorted(compile_patterns(from_list), key=len)
+    if trie is None:
+        trie = PatternTrie()
+        ends = {}
+        for i, p in enumerate(patterns):
+            ends.setdefault(id(trie.add(p)), []).append(i)
+        def ending_at(node):
+            return ends.get(id(node), [])
+    else:
+        positions = dict((id(p), i) for i, p in enumerate(patterns))
+        def ending_at(node):
+            if node.pattern is None or id(node.pattern) not in positions:
+                return []
+            return [positions[id(node.pattern)]]
+
+    for i, c in enumerate(patterns):
+        # Guilty until proven innocent
+        covered = False
+        nodes = [trie]
+        for depth in range(0, len(c) + 1):
+            for node in nodes:
+                for j in ending_at(node):
+                    if j == i:
+                        continue
+                    if len(patterns[j]) < len(c) or j < i or \
+                       not pattern_covers(c, patterns[j]):
+                        covered = True
+                        break
+            if covered or depth == len(c):
+                break
+            nodes = [child for node in nodes
+                     for child in node.children_covering(c[depth])]
+        if covered:
+            redundant.append(c)
+        else:
+            not_redundant.append(c)
     return {'redundant': redundant,
             'not_redundant': not_redundant}
 
+def list_directory(path):
+    """Return a list of (name, is_dir, is_link) tuples for the entries in a
+    directory, or an empty list if it can't be read (as os.walk does).
+    is_dir follows symlinks, so a link to a directory counts as one.
+
+    Uses scandir where available, so whether an entry is a directory comes
+    from the listing itself rather than an extra stat per entry. Without it,
+    each entry takes one lstat, and a symlink a second to follow it.
+    """
+    entries = []
+    try:
+        if scandir is not None:
+            for entry in scandir(path):
+                entries.append((entry.name, entry.is_dir(),
+                                entry.is_symlink()))
+        else:
+            for name in os.listdir(path):
+                full_path = os.path.join(path, name)
+                try:
+                    st = os.lstat(full_path)
+                except OSError:
+                    # Gone since it was listed
+                    entries.append((name, False, False))
+                    continue
+                entries.append(stat_entry(name, full_path, st))
+    except OSError:
+        pass
+    return entries
+
+def is_entry_name(name):
+    """Return True if a directory listing could hold name. The pieces '.'
+    and '..', which split_path leaves at the start of a pattern, can't be
+    listed, so never match anything.
+
+    >>> [is_entry_name(n) for n in ['move_me', '.', '..', '.hidden']]
+    [True, False, False, True]
+    """
+    return name not in ('', os.curdir, os.pardir)
+
+def probe_directory(path, names):
+    """Like list_directory, but only for the given names, which are looked up
+    directly instead of listing their parent. Names which don't exist, or
+    which a listing couldn't hold (see is_entry_name), are left out.
+
+    On a volume which ignores case, a name would be found whatever its case,
+    so there the directory is listed after all and only names with exactly
+    the case asked for are kept - as they would have been from a listing.
+    """
+    entries = []
+    case_checked = False
+    for name in names:
+        if not is_entry_name(name):
+            continue
+        full_path = os.path.join(path, name)
+        try:
+            st = os.lstat(full_path)
+        except OSError:
+            continue
+        if not case_checked and name.swapcase() != name:
+            case_checked = True
+            if ignores_case(path, name, st):
+                wanted = set(names)
+                return [e for e in list_directory(path) if e[0] in wanted]
+        entries.append(stat_entry(name, full_path, st))
+    return entries
+
+def stat_entry(name, full_path, st):
+    """Return the (name, is_dir, is_link) tuple for an entry, as
+    list_directory does, from its lstat st. Only a symlink needs another
+    stat, to see whether it leads to a directory."""
+    is_link = stat.S_ISLNK(st.st_mode)
+    if is_link:
+        return (name, os.path.isdir(full_path), True)
+    return (name, stat.S_ISDIR(st.st_mode), False)
+
+def ignores_case(path, name, st):
+    """Return True if looking up name, whose lstat is st, in the directory
+    path finds the same entry whatever the case it is spelt in."""
+    try:
+        swapped = os.lstat(os.path.join(path, name.swapcase()))
+    except OSError:
+        return False
+    return os.path.samestat(st, swapped)
+
+def scan_directory(root, nodes, index=None, stats=None, matcher=None):
+    """Match the entries of a single directory against the live trie nodes
+    which led to it.
+
+    root : str : path
+        The directory to scan
+    nodes : list : PatternTrie
+        Nodes whose children are candidates for entries in root
+    index : SourceIndex
+        If given, directory listings are answered from this index where it
+        is up to date
+    stats : RunStats
+        If given, counts and timings are added to this
+    matcher : MatchPool
+        If given, entries are matched against any regex pieces in nodes by
+        this pool of processes, rather than here
+
+    :return tuple
+        (dir_matches, file_matches, to_walk), where the matches are lists of
+        (name, pattern) pairs and to_walk is a list of (name, nodes) pairs for
+        subdirectories which may hold further matches.
+    """
+    started = time.time()
+    listed = True
+    # If nothing below root is a glob or regex, there's no need to list it:
+    # just look for the names we want.
+    literal_names = set()
+    for node in nodes:
+        if node.glob is not None or node.regexes:
+            literal_names = None
+            break
+        literal_names.update(node.literals)
+    if literal_names is not None and \
+       len(literal_names) <= LITERAL_PROBE_LIMIT:
+        listed = False
+        entries = None
+        if index is not None:
+            entries = index.probe_directory(root, sorted(literal_names))
+        if entries is None:
+            entries = probe_directory(root, sorted(literal_names))
+    elif index is not None:
+        entries = index.list_directory(root)
+    else:
+        entries = list_directory(root)
+    walked = time.time()
+    (dir_matches, file_matches, to_walk,
+     trie_hits, regex_evaluations) = match_entries(entries, nodes, matcher)
+    if stats is not None:
+        stats.count(dirs_listed=int(listed),
+                    entries_examined=len(entries),
+                    regex_evaluations=regex_evaluations,
+                    trie_hits=trie_hits)
+        stats.add_time('walk', walked - started)
+        stats.add_time('match', time.time() - walked)
+    return dir_matches, file_matches, to_walk
+
+def match_entries(entries, nodes, matcher=None):
+    """Match directory entries, as returned by list_directory, against the
+    live trie nodes which led to their directory. Arguments and results are
+    as for scan_directory, with the number of trie nodes matched and the
+    number of regex matches run (see CombinedRegex) added to the end of the
+    tuple. Every name is tested against every regex node, here or in
+    matcher, so the latter is counted from the nodes rather than as they
+    run.
+    """
+    dir_matches = []
+    file_matches = []
+    to_walk = []
+    trie_hits = 0
+    matched_children = None
+    regex_evaluations = len(entries) * sum(node.regex_matcher().evaluations
+                                           for node in nodes if node.regexes)
+    if matcher is not None and entries and any(n.regexes for n in nodes):
+        matched_children = matcher.children_matching(
+            nodes, [name for name, is_dir, is_link in entries])
+    for i, (name, is_dir, is_link) in enumerate(entries):
+        matched = None
+        below = []
+        if matched_children is not None:
+            children = matched_children[i]
+        else:
+            children = [child for node in nodes
+                        for child in node.children_matching(name)]
+        trie_hits += len(children)
+        for child in children:
+            if child.pattern is not None:
+                # We've got a match! That's the end of the pattern, so
+                # move this object rather than walking into it.
+                if matched is None:
+                    matched = child.pattern
+            elif is_dir:
+                below.append(child)
+        if matched is not None:
+            if is_dir:
+                dir_matches.append((name, matched))
+            else:
+                file_matches.append((name, matched))
+        elif below and not is_link:
+            to_walk.append((name, below))
+    return dir_matches, file_matches, to_walk, trie_hits, regex_evaluations
+
+def literal_anchors(source, trie):
+    """Return (root, nodes) pairs for walk_source to start from, in walk
+    order. Rather than scanning each directory along a run of literal
+    pieces, such as Projects/2014 in Projects/2014/regex{4[0-9]{5}}, the walk
+    starts at the end of the run, so patterns sharing a literal prefix are
+    grouped under a single anchor. For instance Projects/2014/regex{...},
+    Projects/2015/* and Projects/2015/regex{...} give the anchors
+    source/Projects/2014 and source/Projects/2015.
+
+    A run stops at any directory which holds a match itself, or which would
+    be listed rather than probed (see scan_directory). Anchors which don't
+    exist are left out.
+    """
+    anchors = []
+    def descend(names, node):
+        if node.glob is None and not node.regexes and node.literals and \
+           len(node.literals) <= LITERAL_PROBE_LIMIT and \
+           all(child.pattern is None for child in node.literals.values()):
+            for name in sorted(node.literals):
+                if is_entry_name(name):
+                    descend(names + [name], node.literals[name])
+        elif not names:
+            anchors.append((source, [node]))
+        elif is_walkable_dir(source, names):
+            anchors.append((os.path.join(source, *names), [node]))
+    descend([], trie)
+    return anchors
+
+def is_walkable_dir(source, names):
+    """Return True if source/names[0]/names[1]/... is a directory the walk
+    would have gone into, i.e each level below source is listed under
+    exactly that name and none is a symlink. A missing path is found with a
+    single lstat of the full path."""
+    try:
+        os.lstat(os.path.join(source, *names))
+    except OSError:
+        return False
+    path = source
+    for name in names:
+        entries = probe_directory(path, [name])
+        if not entries:
+            return False
+        name, is_dir, is_link = entries[0]
+        if is_link or not is_dir:
+            return False
+        path = os.path.join(path, name)
+    return True
+
+def walk_source(source, trie, workers=1, index=None, stats=None,
+                matcher=None):
+    """Walk source top-down, in the same order as os.walk, yielding a
+    (root, dir_matches, file_matches) tuple for each directory visited (see
+    scan_directory). Only directories on the path of a live pattern are
+    visited, so the walk never goes deeper than the longest pattern, and it
+    begins below source where every pattern starts with the same literal
+    pieces (see literal_anchors).
+
+    source : str : path
+    trie : PatternTrie
+    workers : int : default 1
+        Number of threads to scan directories with. Results are yielded in
+        the same order whatever this is set to.
+    index : SourceIndex
+    stats : RunStats
+    matcher : MatchPool
+        Passed on to scan_directory
+    """
+    anchors = literal_anchors(source, trie)
+    stack = list(reversed(anchors))
+    if workers > 1:
+        scans = ParallelScanner(workers, index, stats, matcher)
+        # Directories submitted to scans and not yet taken back
+        pending = set()
+        ahead = workers * SCAN_AHEAD
+    else:
+        scans = None
+    try:
+        while stack:
+            if scans:
+                # Keep the workers on the directories to be visited next,
+                # and no further ahead than that
+                for root, nodes in reversed(stack[-ahead:]):
+                    if len(pending) >= ahead:
+                        break
+                    if root not in pending:
+                        scans.submit(root, nodes)
+                        pending.add(root)
+            root, nodes = stack.pop()
+            if scans:
+                if root not in pending:
+                    scans.submit(root, nodes)
+                pending.discard(root)
+                dir_matches, file_matches, to_walk = scans.result(root)
+            else:
+                dir_matches, file_matches, to_walk = scan_directory(root,
+                                                                    nodes,
+                                                                    index,
+                                                                    stats,
+                                                                    matcher)
+            yield root, dir_matches, file_matches
+            for name, below in reversed(to_walk):
+                stack.append((os.path.join(root, name), below))
+    finally:
+        if scans:
+            scans.stop()
+
+class ParallelScanner:
+    """Runs scan_directory over a pool of threads, for directories which
+    walk_source submits ahead of visiting them, so sibling subtrees are
+    listed concurrently while it collects the results in order. Results are
+    held until taken, so walk_source bounds how many are held by how far
+    ahead it submits (see SCAN_AHEAD).
+    """
+    def __init__(self, workers, index=None, stats=None, matcher=None):
+        self.index = index
+        self.stats = stats
+        self.matcher = matcher
+        self.work = queue.Queue()
+        self.results = {}
+        self.done = threading.Condition()
+        self.threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self.run)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, root, nodes):
+        self.work.put((root, nodes))
+
+    def run(self):
+        while True:
+            item = self.work.get()
+            if item is None:
+                return
+            root, nodes = item
+            try:
+                result = scan_directory(root, nodes, self.index,
+                                        self.stats, self.matcher)
+            except Exception as e:
+                result = e
+            with self.done:
+                self.results[root] = result
+                self.done.notify_all()
+
+    def result(self, root):
+        """Wait for, and return, the scan_directory result for root."""
+        with self.done:
+            while root not in self.results:
+                # A timeout keeps the wait interruptible on Python 2
+                self.done.wait(0.1)
+            result = self.results.pop(root)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def stop(self):
+        """Stop the worker threads. Anything still queued is dropped."""
+        while True:
+            try:
+                self.work.get_nowait()
+            except queue.Empty:
+                break
+        for t in self.threads:
+            self.work.put(None)
+        for t in self.threads:
+            t.join()
+
+def number_trie(trie):
+    """Return a list of every node in trie, in an order which depends only
+    on the patterns added to it, so that a trie built from the same patterns
+    in another process numbers its nodes the same way."""
+    nodes = []
+    stack = [trie]
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        children = [node.literals[name] for name in sorted(node.literals)]
+        if node.glob is not None:
+            children.append(node.glob)
+        children.extend(child for piece, child in node.regexes)
+        stack.extend(reversed(children))
+    return nodes
+
+# The numbered nodes of the trie held by a MatchPool process, and the
+# number of each node by its id
+match_nodes = None
+match_numbers = None
+
+def init_match_process(patterns):
+    """Build the trie for a MatchPool process, from (pattern,
+    regex_ind_start, regex_ind_end) tuples."""
+    global match_nodes, match_numbers
+    trie = PatternTrie([CompiledPattern(p, start, end)
+                        for p, start, end in patterns])
+    match_nodes = number_trie(trie)
+    match_numbers = dict((id(node), n) for n, node in enumerate(match_nodes))
+
+def match_batch(batch):
+    """Given a (node numbers, names) batch, return for each name the numbers
+    of the nodes' children it matches. Runs in a MatchPool process."""
+    node_numbers, names = batch
+    nodes = [match_nodes[n] for n in node_numbers]
+    return [[match_numbers[id(child)] for node in nodes
+             for child in node.children_matching(name)]
+            for name in names]
+
+class MatchPool:
+    """Matches directory entries against a PatternSet in a pool of
+    processes, so that matching many regexes isn't held to a single core by
+    the GIL. Each process builds its own copy of the trie when it starts,
+    and nodes are passed back and forth by number (see number_trie); only
+    names and numbers cross between processes.
+    """
+    def __init__(self, patterns, processes):
+        """
+        patterns : PatternSet
+        processes : int
+            Number of processes to match with
+        """
+        self.nodes = number_trie(patterns.trie)
+        self.numbers = dict((id(node), n) for n, node in enumerate(self.nodes))
+        to_send = [(list(p), p.pieces[0].regex_ind_start,
+                    p.pieces[0].regex_ind_end) for p in patterns.to_check]
+        self.processes = processes
+        self.pool = multiprocessing.Pool(processes, init_match_process,
+                                         (to_send,))
+
+    def children_matching(self, nodes, names):
+        """Return, for each of names, the children of nodes it matches, in
+        the order they would be found by calling children_matching on each
+        node in turn. Fewer than POOL_MIN_NAMES are matched here; more are
+        split evenly between the pool's processes."""
+        if len(names) < POOL_MIN_NAMES:
+            return [[child for node in nodes
+                     for child in node.children_matching(name)]
+                    for name in names]
+        node_numbers = [self.numbers[id(node)] for node in nodes]
+        size = min(MATCH_BATCH, -(-len(names) // self.processes))
+        batches = [(node_numbers, names[i:i + size])
+                   for i in range(0, len(names), size)]
+        matched = []
+        for batch_result in self.pool.map(match_batch, batches):
+            matched.extend([self.nodes[n] for n in numbers]
+                           for numbers in batch_result)
+        return matched
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+class MatchEvent:
+    """Something found while searching source, as yielded by
+    iter_source_matches.
+
+      MatchEvent.type    : one of
+                           'dir'           - a directory to move
+                           'file'          - a file to move
+                           'satisfied'     - the first match for a pattern
+                           'not_matched'   - a pattern with no matches
+                           'redundant'     - a pattern covered by another
+                           'invalid_regex' - a pattern with a bad regex
+      MatchEvent.pattern : the CompiledPattern concerned
+      MatchEvent.path    : for 'dir' and 'file', the path found
+    """
+    def __init__(self, type, pattern, path=None):
+        self.type = type
+        self.pattern = pattern
+        self.path = path
+
+class PatternSet:
+    """Patterns compiled, checked and pruned of redundancy once, so that any
+    number of sources can be searched for them without doing so again. Safe
+    to search with from several threads at once.
+
+      PatternSet.invalid   : patterns with a regex which won't compile
+      PatternSet.redundant : patterns covered by another
+      PatternSet.to_check  : the patterns left to search for
+      PatternSet.trie      : a PatternTrie of to_check
+    """
+    def __init__(self, patterns, regex_ind_start=None, regex_ind_end=None,
+                 stats=None, redundant=None, trie=None):
+        """
+        patterns : list : lists
+            As for search_source_for_patterns
+        redundant : list : int
+            If given, the positions among the valid patterns of those already
+            known to be redundant - as returned by redundant_positions - so
+            that they needn't be worked out again
+        trie : PatternTrie
+            If given, the trie patterns were read into by read_patterns, to
+            find redundant patterns with (see get_redundant_patterns)
+        """
+        patterns = compile_patterns(patterns, regex_ind_start, regex_ind_end)
+        self.invalid = [p for p in patterns if p.invalid_regex]
+        valid_patterns = [p for p in patterns if not p.invalid_regex]
+        if redundant is None:
+            # Remove any redundant patterns before going on (e.g ['usr','bin']
+            # is redundant if ['usr'] is present.
+            if stats is None:
+                stats = run_stats.RunStats()
+            with stats.phase('redundancy'):
+                redundant_patterns_output = get_redundant_patterns(
+                    valid_patterns, trie)
+            self.redundant = redundant_patterns_output['redundant']
+            self.to_check = redundant_patterns_output['not_redundant']
+        else:
+            redundant = set(redundant)
+            self.redundant = [p for i, p in enumerate(valid_patterns)
+                              if i in redundant]
+            self.to_check = [p for i, p in enumerate(valid_patterns)
+                             if i not in redundant]
+        self.trie = PatternTrie(self.to_check)
+
+    def __len__(self):
+        return len(self.invalid) + len(self.redundant) + len(self.to_check)
+
+    def redundant_positions(self, patterns):
+        """Return the positions of the redundant patterns among the valid
+        ones in patterns, the list of CompiledPatterns this PatternSet was
+        made from."""
+        redundant = set(id(p) for p in self.redundant)
+        valid_patterns = [p for p in patterns if not p.invalid_regex]
+        return [i for i, p in enumerate(valid_patterns) if id(p) in redundant]
+
+def iter_source_matches(source, patterns,
+                        regex_ind_start=None, regex_ind_end=None,
+                        workers=1, index=None, stats=None, processes=1):
+    """
+    Walk the source directory, yielding a MatchEvent for everything of note
+    as soon as it is found, so matches can be acted on while the walk goes
+    on. Arguments are as for search_source_for_patterns.
+
+    Events for invalid and redundant patterns come first, then 'dir',
+    'file' and 'satisfied' events in walk order, then 'not_matched' events
+    once the walk is finished.
+    """
+    if not isinstance(patterns, PatternSet):
+        patterns = PatternSet(patterns, regex_ind_start, regex_ind_end, stats)
+    # Patterns containing a regex which won't compile are reported, and
+    # never searched for.
+    for p in patterns.invalid:
+        yield MatchEvent('invalid_regex', p)
+    for r in patterns.redundant:
+        yield MatchEvent('redundant', r)
+    to_check = patterns.to_check
+
+    matcher = None
+    if processes > 1:
+        matcher = MatchPool(patterns, processes)
+    satisfied = set()
+    try:
+        for root, dir_matches, file_matches in walk_source(source,
+                                                           patterns.trie,
+                                                           workers, index,
+                                                           stats, matcher):
+            for event_type, matches in [('dir', dir_matches),
+                                        ('file', file_matches)]:
+                for name, pattern in matches:
+                    yield MatchEvent(event_type, pattern,
+                                     swisspy.smooth_join(root, name))
+                    if id(pattern) not in satisfied:
+                        satisfied.add(id(pattern))
+                        yield MatchEvent('satisfied', pattern)
+    finally:
+        if matcher is not None:
+            matcher.close()
+    for t in to_check:
+        if id(t) not in satisfied:
+            yield MatchEvent('not_matched', t)
+
 def search_source_for_patterns(source, patterns,
-                               regex_ind_start=None, regex_ind_end=None):
+                               regex_ind_start=None, regex_ind_end=None,
+                               workers=1, index=None, stats=None,
+                               processes=1):
     """
     Walk the source directory and return a list of paths which match patterns.
-    This is the meat. If anything's gone awry, it's probably this function.
+    This is the meat. If anything's gone awry, it's probably this function,
+    or iter_source_matches which does the walking for it.
 
     source : str : path
         The source directory to search for patterns
     patterns : list : lists
-        A list of patterns
+        A list of patterns, compiled by compile_patterns or not, or a
+        PatternSet
     regex_ind_start : str
         String indicating the beginning of a regex pattern
     regex_ind_end : str
         String indicating the end of a regex pattern
+    workers : int : default 1
+        Number of threads to list directories with
+    index : SourceIndex
+        A persistent index of source to answer directory listings from,
+        where it is up to date
+    stats : RunStats
+        If given, counts and timings for the search are added to this
+    processes : int : default 1
+        If more than 1, directory entries are matched against regex pieces
+        by this many processes (see MatchPool), while the walk goes on here
 
     :return dict
         {'dirs_to_move' : list of dirs to move,
@@ -281,77 +1415,135 @@ def search_source_for_patterns(source, patterns,
          'invalid_regex' : Invalid regex patterns encountered.
 
     """
-    dirs_to_move = []
-    files_to_move=[]
-    satisfied = []
-    invalid_regex = []
+    events = iter_source_matches(source, patterns, regex_ind_start,
+                                 regex_ind_end, workers, index, stats,
+                                 processes)
+    return search_result_from_events(events)
 
-    # Remove any redundant patterns before going on (e.g ['usr','bin'] is
-    # redundant if ['usr'] is present.
-    redundant_patterns_output = get_redundant_patterns(patterns)
-    redundant_patterns = redundant_patterns_output['redundant']
-    to_check = redundant_patterns_output['not_redundant']
+class PathList:
+    """A list of paths which is cheap to hold millions of. Each path is kept
+    as the index of its parent directory, in a table of the distinct parents
+    seen, plus its interned name, rather than as a full string. Paths come
+    back out as strings when iterated over or indexed, and the list compares
+    equal to the plain list of them.
 
-    for root, dirs, files in os.walk(source):
-        walk_depth = path_depth_difference(root, source)
-        # Since we remove matches as we go, only to_check representing paths
-        # which are deeper than we've walked so far are eligible to match.
-        possible_patterns = [p for p in to_check if len(p) - 1 >= walk_depth]
-        if not possible_patterns:
-            continue
-        for pattern in possible_patterns:
-            pieces = [PatternPiece(p) for p in pattern]
-            to_match = pieces[walk_depth]
-            for d in dirs[:]:
-                try:
-                    paths_match = match(to_match, d)
-                except Exception:
-                    if to_match.regex_pattern not in invalid_regex:
-                        invalid_regex.append(to_match.regex_pattern)
-                        to_check.remove(pattern)
-                        continue
-                if paths_match:
-                    # We've got a match! If that's the end of the pattern,
-                    # move this object
-                    if len(pattern) - 1 == walk_depth:
-                        dir_path = swisspy.smooth_join(root, d)
-                        dirs_to_move.append(dir_path)
-                        # Remove this dir from dirs to be walked
-                        dirs.remove(d)
-                        satisfied.append(pattern)
-                        # Only remove this from the list to check if it doesn't
-                        # contain a glob
-                        non_strings = [q for q in pieces if q.type != 'string']
-                        if not non_strings:
-                            to_check.remove(pattern)
-            for f in files:
-                try:
-                    paths_match = match(to_match, f)
-                except Exception:
-                    if to_match.regex_pattern not in invalid_regex:
-                        invalid_regex.append(to_match.regex_pattern)
-                        to_check.remove(pattern)
-                        continue
-                if paths_match:
-                    if len(pattern) - 1 == walk_depth:
-                        file_path = swisspy.smooth_join(root, f)
-                        files_to_move.append(file_path)
-                        files.remove(f)
-                        satisfied.append(pattern)
-                        non_strings = [q for q in pieces if q.type != 'string']
-                        if not non_strings:
-                            to_check.remove(pattern)
-    sep = os.path.sep
-    paths_not_matched = [sep.join(t) for t in to_check if t not in satisfied]
-    paths_matched = [sep.join(s) for s in satisfied]
-    redundant_paths = [sep.join(r) for r in redundant_patterns]
-    out_dict = {'dirs_to_move':dirs_to_move,
-                'files_to_move':files_to_move,
-                'invalid_regex':invalid_regex,
-                'paths_matched':paths_matched,
-                'paths_not_matched':paths_not_matched,
-                'redundant_paths':redundant_paths,}
-    return out_dict
+    >>> paths = PathList(['/src/a/b', '/src/a/c', '/src/d'])
+    >>> paths.parents
+    ['/src/a/', '/src/']
+    >>> paths[1]
+    '/src/a/c'
+    >>> paths == ['/src/a/b', '/src/a/c', '/src/d']
+    True
+    >>> paths + ['/src/e']
+    ['/src/a/b', '/src/a/c', '/src/d', '/src/e']
+    """
+    def __init__(self, paths=()):
+        self.parents = []
+        self.parent_ids = {}
+        self.parent_of = array.array('l')
+        self.names = []
+        for path in paths:
+            self.append(path)
+
+    def append(self, path):
+        split = path.rfind(os.path.sep) + 1
+        parent = path[:split]
+        parent_id = self.parent_ids.get(parent)
+        if parent_id is None:
+            parent_id = len(self.parents)
+            self.parents.append(parent)
+            self.parent_ids[parent] = parent_id
+        name = path[split:]
+        if type(name) is str:
+            # Python 2 can only intern byte strings
+            name = intern(name)
+        self.parent_of.append(parent_id)
+        self.names.append(name)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i):
+        return self.parents[self.parent_of[i]] + self.names[i]
+
+    def __iter__(self):
+        parents = self.parents
+        for parent_id, name in zip(self.parent_of, self.names):
+            yield parents[parent_id] + name
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+    def __repr__(self):
+        return repr(list(self))
+
+def search_result_from_events(events):
+    """Gather the MatchEvents from iter_source_matches into the dict
+    returned by search_source_for_patterns."""
+    collector = ResultCollector()
+    for event in events:
+        collector.add(event)
+    return collector.result
+
+class ResultCollector:
+    """Builds the dict returned by search_source_for_patterns one MatchEvent
+    at a time, for callers which can't hand over an iterable of them. Paths
+    to move are kept in PathLists, and each pattern's path is only joined
+    once however many times it matches.
+
+      ResultCollector.result : the dict so far
+    """
+    def __init__(self):
+        self.result = {'dirs_to_move': PathList(),
+                       'files_to_move': PathList(),
+                       'invalid_regex': [],
+                       'paths_matched': [],
+                       'paths_not_matched': [],
+                       'redundant_paths': []}
+        self.joined = {}
+
+    def add(self, event):
+        result = self.result
+        if event.type in ['dir', 'file']:
+            if event.type == 'dir':
+                result['dirs_to_move'].append(event.path)
+            else:
+                result['files_to_move'].append(event.path)
+            pattern_path = self.joined.get(id(event.pattern))
+            if pattern_path is None:
+                pattern_path = join_pattern(event.pattern)
+                self.joined[id(event.pattern)] = pattern_path
+            result['paths_matched'].append(pattern_path)
+        elif event.type == 'not_matched':
+            result['paths_not_matched'].append(join_pattern(event.pattern))
+        elif event.type == 'redundant':
+            result['redundant_paths'].append(join_pattern(event.pattern))
+        elif event.type == 'invalid_regex':
+            invalid_regex = result['invalid_regex']
+            invalid_regex.extend(r for r in event.pattern.invalid_regex
+                                 if r not in invalid_regex)
+
+def is_within(path, directory):
+    """Return True if path is directory, or anywhere below it.
+
+    >>> is_within('/Volumes/Video/archive', '/Volumes/Video')
+    True
+    >>> is_within('/Volumes/Video2', '/Volumes/Video')
+    False
+    """
+    path = os.path.abspath(path)
+    directory = os.path.abspath(directory)
+    return path == directory or path.startswith(directory.rstrip(os.sep) +
+                                                os.sep)
 
 def strip_leading_char(from_str, character='/'):
     """
@@ -366,7 +1558,153 @@ def strip_leading_char(from_str, character='/'):
         out = from_str
     return out
 
-def move_creating_intermediaries(source, to_move, dest):
+def plan_destination_dirs(source, to_move, dest):
+    """Return a sorted list of every directory which will need to exist in
+    dest before the paths in to_move can be moved there. Parents always come
+    before their children.
+
+    >>> plan_destination_dirs('/src', ['/src/a/b/c', '/src/a/d', '/src/e'],
+    ...                       '/dst')
+    ['/dst/a', '/dst/a/b']
+    """
+    dest_dirs = set()
+    for path in to_move:
+        path_after_source = split_path(strip_leading_char(path[len(source):]))
+        path_to_create = dest
+        for p in path_after_source[:-1]:
+            path_to_create = os.path.join(path_to_create, p)
+            dest_dirs.add(path_to_create)
+    return sorted(dest_dirs)
+
+def create_destination_dirs(dest_dirs, known_dirs=None):
+    """Create each directory in dest_dirs, as returned by
+    plan_destination_dirs, unless it is already in known_dirs. Returns the set
+    of directories now known to exist, so it can be handed to
+    move_creating_intermediaries.
+    """
+    if known_dirs is None:
+        known_dirs = set()
+    for d in dest_dirs:
+        if d not in known_dirs:
+            make_dir(d)
+            known_dirs.add(d)
+    return known_dirs
+
+def make_dir(path):
+    """os.mkdir, without complaining if the directory is already there."""
+    try:
+        os.mkdir(path)
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            pass
+        else:
+            raise
+
+def copy_item(to_copy, real_dst):
+    """Copy a file, directory or symlink to real_dst, which must not exist.
+    Symlinks are copied as links, not followed. Returns the number of bytes
+    copied, after checking that real_dst holds as many as to_copy did - if
+    not, the copy is deleted and copy_engine.CopyError raised. A copy which
+    fails part way is deleted too."""
+    expected = copy_engine.content_size(to_copy)
+    try:
+        copied = copy_engine.copy_tree(to_copy, real_dst)
+    except (EnvironmentError, shutil.Error):
+        if os.path.lexists(real_dst):
+            remove_item(real_dst)
+        raise
+    found = copy_engine.content_size(real_dst)
+    if found != expected:
+        remove_item(real_dst)
+        raise copy_engine.CopyError(
+            "{} holds {} bytes, but its copy at {} holds {}".format(
+                to_copy, expected, real_dst, found))
+    return copied
+
+def remove_item(to_remove):
+    """Delete a file, directory tree or symlink."""
+    if os.path.isdir(to_remove) and not os.path.islink(to_remove):
+        shutil.rmtree(to_remove)
+    else:
+        os.unlink(to_remove)
+
+def move_item(to_move, final_destination, same_device=None, stats=None,
+              journal=None):
+    """Move to_move into the directory final_destination, as shutil.move
+    would. If both are on the same device this is a plain os.rename;
+    otherwise, or if the rename fails with EXDEV, it is copied, then
+    deleted.
+
+    same_device : bool
+        Whether to_move and final_destination share a device, if already
+        known. Otherwise this is worked out from their st_dev.
+    stats : RunStats
+        If given, bytes copied between devices are counted here
+    journal : MoveJournal
+        If given, the move is journalled as 'started' before anything is
+        touched, and a copy across devices as 'copied' before the source
+        is deleted
+
+    The source is only deleted once its copy has been checked to hold as
+    many bytes (see copy_item). The rate each item was copied at is logged.
+    """
+    real_dst = os.path.join(final_destination, os.path.basename(to_move))
+    if os.path.exists(real_dst):
+        raise shutil.Error("Destination path '%s' already exists" % real_dst)
+    if same_device is None:
+        same_device = os.lstat(to_move).st_dev == \
+                      os.stat(final_destination).st_dev
+    if journal is not None:
+        journal.record(to_move, 'started')
+    if same_device:
+        try:
+            os.rename(to_move, real_dst)
+        except OSError as e:
+            # Bind mounts and overlay filesystems can share a st_dev while
+            # still refusing renames between them
+            if e.errno != errno.EXDEV:
+                raise
+            same_device = False
+    if not same_device:
+        started = time.time()
+        size = copy_item(to_move, real_dst)
+        elapsed = time.time() - started
+        if journal is not None:
+            journal.record(to_move, 'copied')
+        remove_item(to_move)
+        if stats is not None:
+            stats.count(bytes_copied=size)
+        mci_logger = logging.getLogger('mbr.move_ci')
+        mci_logger.info("Copied {} ({:.1f} MB) in {:.2f}s, {:.1f} MB/s".format(
+            to_move, size / 1e6, elapsed, size / 1e6 / max(elapsed, 1e-6)))
+
+def finish_interrupted_move(source, to_move, dest, state):
+    """Tidy up after a move which was interrupted, having been journalled as
+    reaching state, so it can be carried out again. Returns True if the move
+    turned out to be complete already.
+
+    A move journalled as 'copied' only needed its source deleting. One
+    journalled as 'started' may have left a partial copy behind in dest,
+    which is removed; its destination can't have existed beforehand, or the
+    move wouldn't have started.
+    """
+    path_after_source = split_path(strip_leading_char(to_move[len(source):]))
+    real_dst = os.path.join(dest, *path_after_source)
+    source_exists = os.path.lexists(to_move)
+    if state == 'copied':
+        if source_exists:
+            remove_item(to_move)
+        return True
+    if state == 'started':
+        if not source_exists:
+            # Renamed, or copied and deleted, before the journal caught up
+            return os.path.lexists(real_dst)
+        if os.path.lexists(real_dst):
+            remove_item(real_dst)
+    return False
+
+def move_creating_intermediaries(source, to_move, dest, known_dirs=None,
+                                 same_device=None, stats=None, journal=None):
     """Move a directory to_move from within source to dest, creating any
     intermediate directories between those two as necessary
 
@@ -374,107 +1712,789 @@ def move_creating_intermediaries(source, to_move, dest):
     to_move : str : path
         The directory or file to be moved. Must be within source.
     dest : str : path
+    known_dirs : set : paths
+        Directories in dest already known to exist, which won't be created
+        again. Any created here are added to it.
+    same_device : bool
+    stats : RunStats
+    journal : MoveJournal
+        Passed on to move_item
     """
     mci_logger = logging.getLogger('mbr.move_ci')
     successfully_moved = []
+    if known_dirs is None:
+        known_dirs = set()
     if not os.path.normpath(to_move[:len(source)]) == os.path.normpath(source):
         import sys
-        print "{} is not within {}".format(to_move, source)
+        print("{} is not within {}".format(to_move, source))
         sys.exit(-1)
     path_after_source = split_path(strip_leading_char(to_move[len(source):]))
     path_to_create = ""
     for p in path_after_source[:-1]:
         path_to_create = os.path.join(path_to_create, p)
-        try:
-            dest_path = os.path.join(dest, path_to_create)
-            os.mkdir(dest_path)
-        except OSError as e:
-            if e[0] == 17: # File exists
-                pass
-            else:
-                raise
+        dest_path = os.path.join(dest, path_to_create)
+        if dest_path not in known_dirs:
+            make_dir(dest_path)
+            known_dirs.add(dest_path)
     final_destination = os.path.join(dest, path_to_create)
     try:
-        shutil.move(to_move, final_destination)
+        move_item(to_move, final_destination, same_device, stats, journal)
         successfully_moved.append(path_after_source)
     except shutil.Error as e:
-        if "Destination path" in e.message and "already exists in e.message":
+        if "Destination path" in str(e) and "already exists" in str(e):
             mci_logger.info(e)
         else:
             mci_logger.exception("Error encountered while moving " + to_move)
     return successfully_moved
 
+def join_queue(q):
+    """Like q.join(), but the wait has a timeout, which keeps it
+    interruptible on Python 2."""
+    with q.all_tasks_done:
+        while q.unfinished_tasks:
+            q.all_tasks_done.wait(0.1)
+
+class MoveRecord(object):
+    """The outcome of moving a single item.
+
+      MoveRecord.to_move : the path which was to be moved
+      MoveRecord.type    : 'directories' or 'files'
+      MoveRecord.succeeded : whether it has been moved
+      MoveRecord.moved   : as returned by move_creating_intermediaries -
+                           empty unless the move succeeded
+      MoveRecord.error   : any exception raised while moving, or None
+      MoveRecord.resume_state : the journal state of an interrupted move
+                                being resumed, or None
+
+    A new-style class with slots, as a run holds many of these at once.
+    Only to_move is stored; moved is worked out from it when asked for.
+    """
+    __slots__ = ('to_move', 'type', 'succeeded', 'error', 'resume_state',
+                 'source_length')
+
+    def __init__(self, to_move, type, resume_state=None, source_length=0):
+        """
+        source_length : int
+            The length of the source path to_move is within
+        """
+        self.to_move = to_move
+        self.type = type
+        self.succeeded = False
+        self.error = None
+        self.resume_state = resume_state
+        self.source_length = source_length
+
+    @property
+    def moved(self):
+        if not self.succeeded:
+            return []
+        return [split_path(strip_leading_char(
+            self.to_move[self.source_length:]))]
+
+class MoveExecutor:
+    """Runs move_creating_intermediaries for many items concurrently. Moves
+    are queued by the device they are headed for, and each device gets its
+    own threads, so no more than per_device moves are ever writing to the
+    same device at once. Directories created in dest are remembered across
+    moves, and items already on their destination device are renamed.
+
+    Each device's queue is bounded, so submitting blocks while moves are
+    behind, and finished MoveRecords aren't kept: memory stays flat however
+    many items are moved.
+    """
+    def __init__(self, source, dest, per_device=1, known_dirs=None,
+                 stats=None, journal=None, successes=None,
+                 queue_size=MOVE_QUEUE_SIZE):
+        """
+        source : str : path
+        dest : str : path
+        per_device : int : default 1
+            The maximum number of moves to run at once onto any one device
+        known_dirs : set : paths
+            Directories in dest already known to exist, e.g. as returned by
+            create_destination_dirs
+        stats : RunStats
+            If given, moves, errors and time spent moving are added to this
+        journal : MoveJournal
+            If given, each item's progress is journalled here
+        successes : SuccessLog
+            If given, every item moved is added to this
+        queue_size : int : default MOVE_QUEUE_SIZE
+            The most items to hold waiting to be moved onto any one device
+        """
+        self.source = source
+        self.dest = dest
+        self.per_device = max(1, per_device)
+        self.successes = successes
+        self.queue_size = queue_size
+        self.queues = {}
+        self.threads = []
+        self.devices = {}
+        if known_dirs is None:
+            known_dirs = set()
+        self.known_dirs = known_dirs
+        if stats is None:
+            stats = run_stats.RunStats()
+        self.stats = stats
+        self.journal = journal
+
+    def destination_device(self, to_move):
+        """Return the st_dev of the nearest existing directory to where
+        to_move will end up."""
+        after_source = strip_leading_char(to_move[len(self.source):])
+        parent = os.path.dirname(os.path.join(self.dest, after_source))
+        if parent not in self.devices:
+            existing = parent
+            while not os.path.exists(existing) and \
+                  os.path.dirname(existing) != existing:
+                existing = os.path.dirname(existing)
+            self.devices[parent] = os.stat(existing).st_dev
+        return self.devices[parent]
+
+    def submit(self, to_move, type, resume_state=None):
+        """Queue an item to be moved, and return its MoveRecord. Waits for
+        room if the queue for its device is full.
+
+        to_move : str : path
+            The directory or file to be moved. Must be within source.
+        type : str
+            'directories' or 'files'
+        resume_state : str
+            If this item's move was interrupted, the state it was journalled
+            as reaching
+        """
+        record = self.plan(to_move, type, resume_state)
+        device = self.destination_device(to_move)
+        if device not in self.queues:
+            self.queues[device] = queue.Queue(self.queue_size)
+            for i in range(self.per_device):
+                t = threading.Thread(target=self.run,
+                                     args=(self.queues[device],))
+                t.daemon = True
+                t.start()
+                self.threads.append((t, self.queues[device]))
+        while True:
+            try:
+                # A timeout keeps the wait interruptible on Python 2
+                self.queues[device].put(record, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        return record
+
+    def plan(self, to_move, type, resume_state=None):
+        """Make, and journal, the MoveRecord for an item without queueing
+        it. Arguments are as for submit."""
+        record = MoveRecord(to_move, type, resume_state, len(self.source))
+        if self.journal is not None and resume_state is None:
+            self.journal.record(to_move, 'planned', type)
+        return record
+
+    def run(self, from_queue):
+        while True:
+            record = from_queue.get()
+            if record is None:
+                return
+            try:
+                self.move(record)
+            finally:
+                from_queue.task_done()
+
+    def move(self, record):
+        """Carry out the move for a MoveRecord on the calling thread, filling
+        in its outcome."""
+        started = time.time()
+        try:
+            if record.resume_state and \
+               finish_interrupted_move(self.source, record.to_move,
+                                       self.dest, record.resume_state):
+                record.succeeded = True
+            else:
+                same_device = os.lstat(record.to_move).st_dev == \
+                              self.destination_device(record.to_move)
+                record.succeeded = bool(move_creating_intermediaries(
+                    self.source, record.to_move, self.dest,
+                    self.known_dirs, same_device, self.stats,
+                    self.journal))
+        except (Exception, SystemExit) as e:
+            record.error = e
+            mci_logger = logging.getLogger('mbr.move_ci')
+            mci_logger.exception("Error encountered while moving " +
+                                 record.to_move)
+        finally:
+            if record.succeeded:
+                self.stats.count(moves=1)
+            else:
+                self.stats.count(errors=1)
+            if self.journal is not None:
+                if record.succeeded:
+                    self.journal.record(record.to_move, 'done')
+                else:
+                    self.journal.record(record.to_move, 'failed')
+            if self.successes is not None:
+                self.successes.add(record)
+            self.stats.add_time('move', time.time() - started)
+
+    def wait(self):
+        """Wait for every queued move to finish, and stop the threads. Can
+        be interrupted, and called again to carry on waiting."""
+        for q in self.queues.values():
+            join_queue(q)
+        for t, q in self.threads:
+            q.put(None)
+        for t, q in self.threads:
+            # A timeout keeps the wait interruptible on Python 2
+            while t.is_alive():
+                t.join(0.1)
+        self.queues = {}
+        self.threads = []
+
+class SuccessLog:
+    """Everything successfully moved in a run, to be logged at its end.
+    Paths are spooled to a temporary file for each type as moves finish,
+    rather than held in memory. Safe to add to from several threads.
+    """
+    def __init__(self):
+        self.spools = {}
+        self.lock = threading.Lock()
+
+    def add(self, record):
+        """Add whatever a finished MoveRecord moved."""
+        if not record.succeeded:
+            return
+        with self.lock:
+            if record.type not in self.spools:
+                self.spools[record.type] = tempfile.TemporaryFile()
+            for moved in record.moved:
+                marshal.dump(join_pattern(moved), self.spools[record.type])
+
+    def log(self, source, dest, main_logger, log_text):
+        """Log everything added so far to main_logger, directories first,
+        and start afresh."""
+        with self.lock:
+            spools = self.spools
+            self.spools = {}
+        for moved_type in ['directories', 'files']:
+            spool = spools.pop(moved_type, None)
+            if spool is None:
+                continue
+            header = log_text.success_story.format(type=moved_type,
+                                                   source=source,
+                                                   dest=dest)
+            main_logger.info(header)
+            spool.seek(0)
+            while True:
+                try:
+                    success = marshal.load(spool)
+                except EOFError:
+                    break
+                main_logger.info("\t" + success)
+            spool.close()
+
+class JobLog(logging.Handler):
+    """Holds back everything logged by one of several jobs running at once,
+    so it can be written out in one block when the job finishes rather than
+    mixed in with the others' (see move_batch). Records are spooled to a
+    temporary file rather than held in memory.
+    """
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.spool = tempfile.TemporaryFile()
+
+    def emit(self, record):
+        marshal.dump((record.levelno, self.format(record)), self.spool)
+
+    def replay(self, logger):
+        """Log everything held back to logger, in order, and discard it."""
+        self.spool.seek(0)
+        while True:
+            try:
+                level, message = marshal.load(self.spool)
+            except EOFError:
+                break
+            logger.log(level, message)
+        self.spool.close()
+
+def load_patterns(paths_file, main_logger, log_text, stats, verbose=False,
+                  cache=None):
+    """Read the patterns in paths_file and return them as a PatternSet,
+    logging how many there were to main_logger, or each of them if verbose
+    is set.
+
+    cache : PatternCache
+        If given, and it holds the patterns for paths_file as it is now,
+        they are taken from there rather than checked for redundancy again.
+        Otherwise they are stored there once checked. Not used for standard
+        input, or when verbose is set.
+    """
+    key = None
+    if cache is not None and paths_file != '-':
+        with stats.phase('parse'):
+            key = cache.key(paths_file)
+            entry = None
+            if not verbose:
+                entry = cache.load(key)
+            if entry is not None:
+                digest, split_patterns, redundant = entry
+                shared_pieces = {}
+                patterns = [CompiledPattern(p, shared_pieces=shared_pieces)
+                            for p in split_patterns]
+                pattern_set = PatternSet(patterns, redundant=redundant)
+        if entry is not None:
+            main_logger.info(log_text.patterns_cached.format(
+                count=len(patterns), path_file=paths_file, digest=digest))
+            return pattern_set
+    pattern_logger = None
+    if verbose:
+        pattern_logger = main_logger
+    read_trie = PatternTrie()
+    with stats.phase('parse'):
+        patterns, digest = read_patterns(paths_file, logger=pattern_logger,
+                                         trie=read_trie)
+    main_logger.info(log_text.patterns_read.format(
+        count=len(patterns), path_file=paths_file, digest=digest))
+    pattern_set = PatternSet(patterns, stats=stats, trie=read_trie)
+    if key is not None:
+        cache.store(key, digest, patterns,
+                    pattern_set.redundant_positions(patterns))
+    return pattern_set
+
 def move_by_regex(source, dest, paths_file="", log_file="", read_only=False,
-                  log_unmatched=False):
+                  log_unmatched=False, workers=1, moves_per_device=1,
+                  index_file=None, stats_file=None, journal_file=None,
+                  resume=False, plan_file=None, apply_file=None,
+                  match_processes=1, watch_interval=None, verbose=False,
+                  pattern_cache_dir=None):
+    """Move everything in source matching the patterns in paths_file to
+    dest, logging to log_file. Returns a RunStats object holding counts and
+    timings for the run, whose summary is also logged.
+
+    If journal_file is given, progress is journalled there as the run goes.
+    With resume, an earlier run's journal is picked up: if its search had
+    finished, source isn't searched again and only its unfinished moves are
+    carried out.
+
+    If plan_file is given, nothing is moved: the result of the search is
+    written there instead, to be carried out later by passing the same file
+    as apply_file, which moves exactly what it lists without searching -
+    or, with read_only, logs what it would move.
+
+    If watch_interval is given, source is watched once it has been searched
+    and new matches are moved as they appear, until the run is interrupted
+    (see watch_source).
+
+    Patterns are only counted in the log unless verbose is set, in which
+    case each is logged in full. If pattern_cache_dir is given, patterns are
+    cached there once checked for redundancy, and reused by later runs with
+    the same paths file (see PatternCache).
+    """
 
     # Set up variables
-    dir_successes = []
-    file_successes = []
     log_text = log_messages.LogMessage()
+    default_paths_file, default_log_file = get_default_files()
+    if not paths_file:
+        paths_file = default_paths_file
+    if not log_file:
+        log_file = default_log_file
     # Set up logging
     init_logging(log_file, log_text)
     main_logger = logging.getLogger('mbr.main')
-    swisspy_path = swisspy.get_dir_currently_running_in()
-    current_dir = swisspy.smooth_join(swisspy_path, '..')
-    if not paths_file:
-        paths_file = os.path.join(current_dir, 'enter_paths_here.txt')
-    if not log_file:
-        log_file = os.path.join(current_dir, 'logs', 'move_log.txt')
 
-    paths = get_lines(paths_file)
-    main_logger.info("\n".join(paths))
+    stats = run_stats.RunStats()
+    cache = None
+    if pattern_cache_dir:
+        cache = pattern_cache.PatternCache(pattern_cache_dir)
+    move_source(source, dest, paths_file, main_logger, log_text, stats,
+                read_only, log_unmatched, workers, moves_per_device,
+                index_file, journal_file, resume, plan_file, apply_file,
+                match_processes=match_processes,
+                watch_interval=watch_interval, verbose=verbose, cache=cache)
+    main_logger.info(log_text.stats_header)
+    main_logger.info(stats.summary())
+    flush_logging()
+    if stats_file:
+        stats.write_json(stats_file)
+    return stats
+
+def move_source(source, dest, paths_file, main_logger, log_text, stats,
+                read_only=False, log_unmatched=False, workers=1,
+                moves_per_device=1, index_file=None, journal_file=None,
+                resume=False, plan_file=None, apply_file=None,
+                pattern_set=None, match_processes=1, watch_interval=None,
+                verbose=False, cache=None):
+    """Do the work of move_by_regex for one source, once logging is set up,
+    logging to main_logger and adding counts and timings to stats.
+
+    Patterns are only counted in the log, along with a hash of them, unless
+    verbose is set, in which case each one is logged as it is read. cache is
+    passed on to load_patterns.
+
+    pattern_set : PatternSet
+        If given, search for these rather than reading paths_file
+    watch_interval : float
+        If given, keep watching source once it has been searched, as
+        watch_source does, checking for changes this often
+    """
+    journal = None
+    if plan_file:
+        read_only = True
+    if journal_file and not read_only:
+        journal = move_journal.MoveJournal(journal_file, source, dest,
+                                           resume)
+    successes = SuccessLog()
+    if journal is not None and journal.search_complete:
+        main_logger.info(log_text.resuming.format(journal_file=journal_file))
+        executor = MoveExecutor(source, dest, moves_per_device, stats=stats,
+                                journal=journal, successes=successes)
+        for path, moved_type, state in journal.unfinished():
+            executor.submit(path, moved_type, state)
+        executor.wait()
+        successes.log(source, dest, main_logger, log_text)
+        paths = None
+    elif apply_file and read_only:
+        # Only say what the plan would move
+        plan = move_journal.read_plan(apply_file, source)
+        log_found(plan, main_logger, log_text)
+        paths = None
+    elif apply_file:
+        plan = move_journal.read_plan(apply_file, source)
+        main_logger.info(log_text.applying_plan.format(plan_file=apply_file))
+        to_move = plan['dirs_to_move'] + plan['files_to_move']
+        known_dirs = create_destination_dirs(
+            plan_destination_dirs(source, to_move, dest))
+        executor = MoveExecutor(source, dest, moves_per_device, known_dirs,
+                                stats, journal, successes)
+        for dir_path in plan['dirs_to_move']:
+            executor.submit(dir_path, 'directories')
+        for file_path in plan['files_to_move']:
+            executor.submit(file_path, 'files')
+        if journal is not None:
+            journal.mark_search_complete()
+        executor.wait()
+        successes.log(source, dest, main_logger, log_text)
+        paths = None
+    elif pattern_set is not None:
+        paths = pattern_set
+    else:
+        paths = load_patterns(paths_file, main_logger, log_text, stats,
+                              verbose, cache)
     if paths:
-        patterns = get_patterns(paths)
-        search_result = search_source_for_patterns(source, patterns)
+        patterns = paths
+        if watch_interval is not None:
+            watch_source(source, dest, patterns, main_logger, log_text,
+                         stats, read_only, moves_per_device, watch_interval,
+                         match_processes)
+            return
+        index = None
+        if index_file:
+            index = source_index.SourceIndex(index_file, source,
+                                             list_directory)
+        events = iter_source_matches(source, patterns, workers=workers,
+                                     index=index, stats=stats,
+                                     processes=match_processes)
+        journalled = set()
+        if not read_only:
+            executor = MoveExecutor(source, dest, moves_per_device,
+                                    stats=stats, journal=journal,
+                                    successes=successes)
+            if journal is not None:
+                # Finish off anything an interrupted run left half done,
+                # and don't move again what it already planned.
+                journalled = set(journal.states)
+                for path, moved_type, state in journal.unfinished():
+                    executor.submit(path, moved_type, state)
+            if is_within(dest, source):
+                # Moving as we go would feed moved items back into the walk
+                events = list(events)
         if read_only:
-            if search_result['dirs_to_move']:
-                header = log_text.found_files_header.format(type='Directories')
-                main_logger.info(header)
-                main_logger.info('\n\t' +\
-                                 '\n\t'.join(search_result['dirs_to_move']))
-            if search_result['files_to_move']:
-                header = log_text.found_files_header.format(type='Files')
-                main_logger.info(header)
-                main_logger.info('\n\t' +\
-                                 '\n\t'.join(search_result['files_to_move']))
+            search_result = search_result_from_events(events)
+            paths_not_matched = search_result['paths_not_matched']
+            if plan_file:
+                move_journal.write_plan(plan_file, source, search_result)
+                main_logger.info(log_text.plan_written.format(
+                    plan_file=plan_file))
+            log_found(search_result, main_logger, log_text)
         else:
-            for dir_path in search_result['dirs_to_move']:
-                dir_successes = move_creating_intermediaries(source,
-                                                             dir_path,
-                                                             dest)
-            if dir_successes:
-                header = log_text.success_story.format(type='directories',
-                                                       source=source,
-                                                       dest=dest)
-                main_logger.info(header)
-                for ds in dir_successes:
-                    main_logger.info("\t" + join_pattern(ds))
-            for file_path in search_result['files_to_move']:
-                file_successes = move_creating_intermediaries(source,
-                                                              file_path,
-                                                              dest)
-            if file_successes:
-               header = log_text.success_story.format(type='files',
-                                                      source=source,
-                                                      dest=dest)
-               main_logger.info(header)
-               for fs in file_successes:
-                   main_logger.info("\t" + join_pattern(fs))
+            paths_not_matched = []
+            # Moves start as soon as each match is found, while the walk
+            # goes on
+            for event in events:
+                if event.type in ['dir', 'file']:
+                    if event.path in journalled:
+                        continue
+                    elif event.type == 'dir':
+                        executor.submit(event.path, 'directories')
+                    else:
+                        executor.submit(event.path, 'files')
+                elif event.type == 'not_matched':
+                    paths_not_matched.append(join_pattern(event.pattern))
+            if journal is not None:
+                journal.mark_search_complete()
+            executor.wait()
+            successes.log(source, dest, main_logger, log_text)
+        if index is not None:
+            index.close()
         if log_unmatched:
             main_logger.info(log_text.unmatched_header)
-            for p in search_result['paths_not_matched']:
+            for p in paths_not_matched:
                 main_logger.info(p)
-    else:
+    elif paths is not None:
         main_logger.info(log_text.no_patterns.format(path_file=paths_file))
+    if journal is not None:
+        journal.close()
+
+def log_found(search_result, main_logger, log_text):
+    """Log the directories and files in a search result, as found rather
+    than moved, for a read-only run."""
+    if search_result['dirs_to_move']:
+        header = log_text.found_files_header.format(type='Directories')
+        main_logger.info(header)
+        main_logger.info('\n\t' +\
+                         '\n\t'.join(search_result['dirs_to_move']))
+    if search_result['files_to_move']:
+        header = log_text.found_files_header.format(type='Files')
+        main_logger.info(header)
+        main_logger.info('\n\t' +\
+                         '\n\t'.join(search_result['files_to_move']))
+
+def watch_source(source, dest, patterns, main_logger, log_text, stats,
+                 read_only=False, moves_per_device=1, interval=5,
+                 processes=1, polls=None):
+    """Move everything in source matching patterns to dest, then keep
+    watching source, moving new matches as they appear, until interrupted.
+    Only directories which change are listed again, and only their new
+    entries are matched (see SourceWatch).
+
+    patterns : list : lists
+        As for search_source_for_patterns
+    interval : float : default 5
+        The longest to wait between checks for changes, in seconds. With
+        inotify, changes are picked up as soon as they happen.
+    processes : int : default 1
+        As for search_source_for_patterns
+    polls : int
+        If given, stop after checking for changes this many times
+    """
+    if not isinstance(patterns, PatternSet):
+        patterns = PatternSet(patterns, stats=stats)
+    matcher = None
+    if processes > 1:
+        matcher = MatchPool(patterns, processes)
+
+    def list_changed(path):
+        with stats.phase('walk'):
+            entries = list_directory(path)
+        stats.count(dirs_listed=1)
+        return entries
+
+    def match(entries, nodes):
+        with stats.phase('match'):
+            result = match_entries(entries, nodes, matcher)
+        stats.count(entries_examined=len(entries), trie_hits=result[3],
+                    regex_evaluations=result[4])
+        return result
+
+    watch = source_watch.SourceWatch(source, patterns.trie, list_changed,
+                                     match)
+    main_logger.info(log_text.watching.format(source=source,
+                                              interval=interval))
+    found = watch.walk()
+    checked = 0
+    executor = None
+    successes = SuccessLog()
+    try:
+        while True:
+            executor = MoveExecutor(source, dest, moves_per_device,
+                                    stats=stats, successes=successes)
+            for root, dir_matches, file_matches in found:
+                for moved_type, matches in [('directories', dir_matches),
+                                            ('files', file_matches)]:
+                    for name, pattern in matches:
+                        path = swisspy.smooth_join(root, name)
+                        if is_within(path, dest):
+                            # Something already moved, if dest is in source
+                            continue
+                        if read_only:
+                            main_logger.info(
+                                log_text.watch_found.format(path=path))
+                        else:
+                            executor.submit(path, moved_type)
+            executor.wait()
+            successes.log(source, dest, main_logger, log_text)
+            executor = None
+            if polls is not None and checked >= polls:
+                break
+            checked += 1
+            found = watch.poll(interval)
+    except KeyboardInterrupt:
+        if executor is not None:
+            # Let the moves already queued finish
+            executor.wait()
+            successes.log(source, dest, main_logger, log_text)
+        main_logger.info(log_text.watch_stopped.format(source=source))
+    finally:
+        watch.close()
+        if matcher is not None:
+            matcher.close()
+
+def read_manifest(manifest_file, paths_file):
+    """Return a (source, dest, paths_file) tuple for each job in a batch
+    manifest. Each line of the manifest holds a source, a destination and,
+    optionally, a paths file to use in place of paths_file, separated by
+    tabs. Blank lines and those starting with '#' are ignored."""
+    jobs = []
+    for line in get_lines(manifest_file):
+        if not line:
+            continue
+        fields = [f.strip() for f in line.split('\t')]
+        if len(fields) == 2:
+            fields.append(paths_file)
+        if len(fields) != 3:
+            raise ValueError("Can't read manifest line: {}".format(line))
+        jobs.append(tuple(fields))
+    return jobs
+
+def move_batch(manifest_file, paths_file="", log_file="", read_only=False,
+               log_unmatched=False, workers=1, moves_per_device=1,
+               stats_file=None, match_processes=1, verbose=False,
+               pattern_cache_dir=None):
+    """Run move_by_regex for every job listed in manifest_file (see
+    read_manifest) in a single process, logging all of them to log_file.
+
+    Each paths file is read and its patterns compiled and pruned only once,
+    however many jobs share it, or taken from pattern_cache_dir as for
+    move_by_regex. The jobs then run at once, each searching
+    with its own workers and moving with its own moves_per_device. Returns
+    a RunStats object totalling every job. Everything a job logs, ending
+    with its own summary, is held back until it finishes and then logged in
+    one block, so the jobs' logs don't interleave; the total comes at the
+    end.
+    """
+    log_text = log_messages.LogMessage()
+    default_paths_file, default_log_file = get_default_files()
+    if not paths_file:
+        paths_file = default_paths_file
+    if not log_file:
+        log_file = default_log_file
+    init_logging(log_file, log_text)
+    main_logger = logging.getLogger('mbr.main')
+
+    stats = run_stats.RunStats()
+    cache = None
+    if pattern_cache_dir:
+        cache = pattern_cache.PatternCache(pattern_cache_dir)
+    jobs = read_manifest(manifest_file, paths_file)
+    pattern_sets = {}
+    for source, dest, job_paths_file in jobs:
+        if job_paths_file in pattern_sets:
+            continue
+        if verbose:
+            main_logger.info(log_text.batch_patterns.format(
+                path_file=job_paths_file))
+        pattern_sets[job_paths_file] = load_patterns(job_paths_file,
+                                                     main_logger, log_text,
+                                                     stats, verbose, cache)
+
+    log_lock = threading.Lock()
+
+    def run_job(n, source, dest, job_paths_file, job_stats):
+        job_log = JobLog()
+        job_logger = logging.Logger(main_logger.name)
+        job_logger.setLevel(logging.INFO)
+        job_logger.addHandler(job_log)
+        job_logger.info(log_text.batch_job.format(n=n + 1, source=source,
+                                                  dest=dest))
+        try:
+            move_source(source, dest, job_paths_file, job_logger, log_text,
+                        job_stats, read_only, log_unmatched, workers,
+                        moves_per_device,
+                        pattern_set=pattern_sets[job_paths_file],
+                        match_processes=match_processes, verbose=verbose)
+        except Exception:
+            job_stats.count(errors=1)
+            job_logger.exception(log_text.batch_job_failed.format(
+                source=source))
+        job_logger.info(log_text.batch_job_stats_header.format(
+            source=source, dest=dest))
+        job_logger.info(job_stats.summary())
+        with log_lock:
+            job_log.replay(main_logger)
+
+    threads = []
+    for n, (source, dest, job_paths_file) in enumerate(jobs):
+        job_stats = run_stats.RunStats()
+        t = threading.Thread(target=run_job, args=(n, source, dest,
+                                                   job_paths_file,
+                                                   job_stats))
+        t.start()
+        threads.append((t, job_stats))
+    for t, job_stats in threads:
+        t.join()
+        stats.merge(job_stats)
+    main_logger.info(log_text.batch_stats_header.format(jobs=len(jobs)))
+    main_logger.info(stats.summary())
+    flush_logging()
+    if stats_file:
+        stats.write_json(stats_file)
+    return stats
+
+def get_default_files():
+    """Return the default (paths_file, log_file), which live alongside the
+    directory this is running in."""
+    swisspy_path = swisspy.get_dir_currently_running_in()
+    current_dir = swisspy.smooth_join(swisspy_path, '..')
+    return (os.path.join(current_dir, 'enter_paths_here.txt'),
+            os.path.join(current_dir, 'logs', 'move_log.txt'))
+
+def has_patterns(paths_file):
+    """Return True if paths_file holds any patterns, as read by get_lines,
+    reading no further than the first. Standard input is assumed to, as
+    it can't be looked at without using it up."""
+    if paths_file == '-':
+        return True
+    for line in iter_lines(paths_file):
+        if line:
+            return True
+    return False
+
+def exit_on_sigterm(signum, frame):
+    """Turn SIGTERM into SystemExit, so that a run which is killed still
+    writes out everything it has logged before it goes."""
+    sys.exit(128 + signum)
 
 def main():
     swisspy_path = swisspy.get_dir_currently_running_in()
     current_dir = swisspy.smooth_join(swisspy_path, '..')
     args = init_args(current_dir)
-    move_by_regex(args.source, args.dest, args.paths_file, args.log_file,
-                  args.read_only, args.log_unmatched)
+    signal.signal(signal.SIGTERM, exit_on_sigterm)
+    default_paths_file, default_log_file = get_default_files()
+    paths_file = args.paths_file or default_paths_file
+    if not (args.batch_file or args.apply_file or args.resume or
+            args.stats or args.stats_file) and not has_patterns(paths_file):
+        # Nothing to search for, so don't set anything else up
+        log_text = log_messages.LogMessage()
+        init_logging(args.log_file or default_log_file, log_text)
+        main_logger = logging.getLogger('mbr.main')
+        main_logger.info(log_text.no_patterns.format(path_file=paths_file))
+        return
+    if args.batch_file:
+        stats = move_batch(args.batch_file, args.paths_file, args.log_file,
+                           args.read_only, args.log_unmatched, args.workers,
+                           args.moves_per_device, args.stats_file,
+                           args.match_processes, args.verbose,
+                           args.pattern_cache_dir)
+    else:
+        stats = move_by_regex(args.source, args.dest, args.paths_file,
+                              args.log_file, args.read_only,
+                              args.log_unmatched, args.workers,
+                              args.moves_per_device, args.index_file,
+                              args.stats_file, args.journal_file,
+                              args.resume, args.plan_file, args.apply_file,
+                              args.match_processes, args.watch_interval,
+                              args.verbose, args.pattern_cache_dir)
+    if args.stats:
+        print(stats.summary())
 
 if __name__== '__main__':
-    import doctest
-    doctest.testmod()
+    # Doctests are run with: python -m doctest move_by_regex.py
     main()
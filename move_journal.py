@@ -0,0 +1,189 @@
+"""A journal of the moves made by a run of move_by_regex, written as it goes,
+so that an interrupted run can be picked up where it left off rather than
+searching and moving everything again.
+
+The journal is a text file with one JSON object per line. The first line
+records the source and destination of the run; after that, each line records
+an item reaching a new state:
+
+  planned - found by the search, and due to be moved
+  started - the move has begun
+  copied  - a move across devices has finished copying, but the source has
+            not yet been removed
+  done    - moved
+  failed  - the move failed, and won't be retried
+
+Once the search has finished, a line {"search_complete": true} is written,
+after which the planned set is known to be complete.
+
+Paths are written as the bytes they are on disk, one character per byte
+(see encode_path), so that any name can be journalled, whether or not it is
+valid UTF-8, and is read back as the same native str the walk yields.
+
+Plans, written by write_plan, are a single compact JSON object holding the
+result of a search, so that it can be carried out later without searching
+again. Their paths and patterns are written in the same way.
+"""
+
+import json
+import os
+import sys
+import threading
+
+# 2: paths written as by encode_path
+PLAN_FORMAT = 2
+
+def encode_path(path):
+    """Return path as text which json can write, whatever bytes it holds:
+    each byte of the path on disk becomes the character with that code.
+
+    >>> decode_path(encode_path('caf\\xc3\\xa9')) == 'caf\\xc3\\xa9'
+    True
+    """
+    if not isinstance(path, bytes):
+        if hasattr(os, 'fsencode'):
+            # Undecodable bytes are held as surrogates on Python 3
+            path = os.fsencode(path)
+        else:
+            path = path.encode(sys.getfilesystemencoding() or 'utf-8')
+    return path.decode('latin-1')
+
+def decode_path(text):
+    """Return the native str path which encode_path turned into text."""
+    path = text.encode('latin-1')
+    if hasattr(os, 'fsdecode'):
+        return os.fsdecode(path)
+    return path
+
+class JournalMismatch(Exception):
+    """Raised when resuming from a journal, or applying a plan, written for a
+    different source or destination."""
+    pass
+
+def write_plan(path, source, search_result):
+    """Write the dict returned by search_source_for_patterns for source to
+    path, as a plan for read_plan to pick up."""
+    # Paths to move may be held in PathLists, which json can't write
+    search_result = dict((key, [encode_path(v) for v in value])
+                         for key, value in search_result.items())
+    plan = {'format': PLAN_FORMAT,
+            'source': encode_path(source),
+            'search_result': search_result}
+    with open(path, 'w') as plan_file:
+        json.dump(plan, plan_file, separators=(',', ':'))
+
+def read_plan(path, source):
+    """Return the search result saved in a plan by write_plan, after
+    checking it was made for source."""
+    with open(path) as plan_file:
+        plan = json.load(plan_file)
+    if plan.get('format') != PLAN_FORMAT:
+        raise JournalMismatch("{} is not a plan this version can read"
+                              .format(path))
+    plan_source = decode_path(plan['source'])
+    if os.path.normpath(plan_source) != os.path.normpath(source):
+        raise JournalMismatch("{} was made for {}".format(path, plan_source))
+    return dict((str(key), [decode_path(v) for v in value])
+                for key, value in plan['search_result'].items())
+
+class MoveJournal:
+    """Reads and appends to a journal file. Safe to write to from several
+    threads at once.
+
+      MoveJournal.states          : dict mapping each path to its last state
+      MoveJournal.types           : dict mapping each path to 'directories'
+                                    or 'files'
+      MoveJournal.planned         : paths in the order they were planned
+      MoveJournal.search_complete : True if the search had finished
+    """
+    def __init__(self, path, source, dest, resume=False):
+        """
+        path : str : path
+            The journal file
+        source : str : path
+        dest : str : path
+            The source and destination of the run
+        resume : bool : default False
+            If True, read what has already been journalled at path and carry
+            on appending to it. Otherwise start a new journal.
+        """
+        self.path = path
+        self.source = source
+        self.dest = dest
+        self.lock = threading.Lock()
+        self.states = {}
+        self.types = {}
+        self.planned = []
+        self.search_complete = False
+        if resume and os.path.exists(path):
+            self.load()
+            self.journal_file = open(path, 'a')
+        else:
+            self.journal_file = open(path, 'w')
+            self.write({'source': encode_path(source),
+                        'dest': encode_path(dest)})
+
+    def load(self):
+        with open(self.path) as journal_file:
+            lines = journal_file.readlines()
+        for n, line in enumerate(lines):
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # A line cut short by the interruption
+                continue
+            if n == 0:
+                source = decode_path(entry.get('source', ''))
+                dest = decode_path(entry.get('dest', ''))
+                if os.path.normpath(source) != \
+                   os.path.normpath(self.source) or \
+                   os.path.normpath(dest) != os.path.normpath(self.dest):
+                    raise JournalMismatch(
+                        "{} was written for {} -> {}".format(
+                            self.path, source, dest))
+            elif entry.get('search_complete'):
+                self.search_complete = True
+            else:
+                path = decode_path(entry['path'])
+                if path not in self.states:
+                    self.planned.append(path)
+                self.states[path] = entry['state']
+                if 'type' in entry:
+                    self.types[path] = entry['type']
+
+    def write(self, entry):
+        with self.lock:
+            self.journal_file.write(json.dumps(entry) + "\n")
+            self.journal_file.flush()
+
+    def record(self, path, state, type=None):
+        """Journal path as having reached state, one of 'planned', 'started',
+        'copied', 'done' or 'failed'."""
+        entry = {'path': encode_path(path), 'state': state}
+        if type is not None:
+            entry['type'] = type
+        with self.lock:
+            if path not in self.states:
+                self.planned.append(path)
+            self.states[path] = state
+            if type is not None:
+                self.types[path] = type
+        self.write(entry)
+
+    def mark_search_complete(self):
+        self.search_complete = True
+        self.write({'search_complete': True})
+
+    def unfinished(self):
+        """Return (path, type, state) for every planned item not yet done or
+        failed, in the order they were planned."""
+        with self.lock:
+            return [(p, self.types.get(p, 'directories'), self.states[p])
+                    for p in self.planned
+                    if self.states[p] not in ('done', 'failed')]
+
+    def close(self):
+        with self.lock:
+            self.journal_file.flush()
+            os.fsync(self.journal_file.fileno())
+            self.journal_file.close()
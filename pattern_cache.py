@@ -0,0 +1,147 @@
+"""An on-disk cache of pattern files which have already been read and pruned
+of redundancy, so that a run whose paths file hasn't changed since an
+earlier one doesn't check every pattern against every other again.
+
+Entries are keyed by a hash of the paths file's contents, the regex
+indicators it was read with and the version of Python reading it, so any
+change to the file is a miss rather than a stale hit. Each entry holds the
+patterns, split but not compiled, and which of them were redundant, in
+marshal format: rebuilding the compiled patterns from that is quicker than
+unpickling them. The least recently used entries are removed once the cache
+holds more than max_bytes.
+"""
+
+import hashlib
+import marshal
+import os
+import sys
+
+CACHE_FORMAT = 1
+
+# Default limit on the total size of the entries in a cache directory
+MAX_BYTES = 256 * 1024 * 1024
+
+# Size of each read made while hashing a paths file
+HASH_CHUNK = 1024 * 1024
+
+class PatternCache:
+    """A directory of cached pattern files, one file per entry.
+
+    >>> import shutil, tempfile
+    >>> cache = PatternCache(tempfile.mkdtemp())
+    >>> cache.store('k', 'digest', [['tmp', 'gog'], ['tmp']], [0])
+    >>> cache.load('k')
+    ('digest', [['tmp', 'gog'], ['tmp']], [0])
+    >>> cache.load('other') is None
+    True
+    >>> shutil.rmtree(cache.cache_dir)
+    """
+    def __init__(self, cache_dir, max_bytes=MAX_BYTES):
+        """
+        cache_dir : str : path
+            The directory to keep entries in. Created if need be.
+        max_bytes : int : default MAX_BYTES
+            Entries are removed, least recently used first, to keep their
+            total size within this
+        """
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def key(self, paths_file, regex_ind_start="regex{", regex_ind_end="}"):
+        """Return the key for paths_file as it is now, read with the given
+        regex indicators."""
+        h = hashlib.sha1()
+        settings = "{}\n{}\n{}\n{}\n".format(CACHE_FORMAT,
+                                            sys.version_info[:2],
+                                            regex_ind_start, regex_ind_end)
+        h.update(settings.encode('utf-8'))
+        with open(paths_file, 'rb') as f:
+            while True:
+                chunk = f.read(HASH_CHUNK)
+                if not chunk:
+                    break
+                h.update(chunk)
+        return h.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key + '.patterns')
+
+    def load(self, key):
+        """Return the (digest, patterns, redundant) stored for key, as passed
+        to store, or None if there is no usable entry."""
+        path = self.entry_path(key)
+        try:
+            with open(path, 'rb') as f:
+                entry = marshal.load(f)
+        except (IOError, OSError):
+            return None
+        except (EOFError, ValueError, TypeError):
+            # Cut short, or otherwise unreadable
+            self.remove(path)
+            return None
+        if not isinstance(entry, tuple) or len(entry) != 4 or \
+           entry[0] != CACHE_FORMAT:
+            self.remove(path)
+            return None
+        # Mark it as recently used, so it's the last to be evicted
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return entry[1:]
+
+    def store(self, key, digest, patterns, redundant):
+        """Store an entry for key, then evict old entries if the cache has
+        grown too big.
+
+        digest : str
+            As returned by move_by_regex.read_patterns
+        patterns : list : lists
+            The patterns read, split into pieces
+        redundant : list : int
+            As returned by PatternSet.redundant_positions
+        """
+        path = self.entry_path(key)
+        # Written under another name first, so no run ever reads half of it
+        partial = "{}.{}.partial".format(path, os.getpid())
+        try:
+            with open(partial, 'wb') as f:
+                marshal.dump((CACHE_FORMAT, digest,
+                              [list(p) for p in patterns], list(redundant)),
+                             f)
+            os.rename(partial, path)
+        except (IOError, OSError):
+            # A cache which can't be written to shouldn't stop the run
+            self.remove(partial)
+            return
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until those left fit
+        within max_bytes."""
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.patterns'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            self.remove(path)
+            total -= size
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
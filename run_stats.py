@@ -0,0 +1,93 @@
+"""Counters and phase timings for a single run of move_by_regex, which can be
+written to the log as a table or saved as JSON to track performance from run
+to run."""
+
+import contextlib
+import json
+import threading
+import time
+
+COUNTERS = ['dirs_listed', 'entries_examined', 'regex_evaluations',
+            'trie_hits', 'moves', 'bytes_copied', 'errors']
+
+class RunStats:
+    """Collects counts and timings from anywhere in a run. Safe to update from
+    several threads at once.
+
+      RunStats.counts : dict mapping each name in COUNTERS to a count
+      RunStats.times  : dict mapping a phase name to seconds spent in it
+
+    Phases which run on several threads at once (walking, matching and
+    moving) report the time summed over every thread, so can add up to more
+    than the wall time of the run.
+
+    >>> stats = RunStats()
+    >>> stats.count(dirs_listed=1, entries_examined=12)
+    >>> stats.count(entries_examined=3)
+    >>> stats.counts['entries_examined']
+    15
+    >>> stats.add_time('walk', 0.5)
+    >>> stats.add_time('walk', 0.25)
+    >>> stats.times['walk']
+    0.75
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = dict((c, 0) for c in COUNTERS)
+        self.times = {}
+        self.phase_order = []
+        self.started = time.time()
+
+    def count(self, **counts):
+        """Add to one or more counters, e.g stats.count(moves=1)"""
+        with self.lock:
+            for name, n in counts.items():
+                self.counts[name] += n
+
+    def add_time(self, phase, seconds):
+        """Add seconds to the time spent in phase."""
+        with self.lock:
+            if phase not in self.times:
+                self.times[phase] = 0.0
+                self.phase_order.append(phase)
+            self.times[phase] += seconds
+
+    def merge(self, other):
+        """Add the counts and timings of another RunStats to these."""
+        stats = other.as_dict()
+        self.count(**stats['counts'])
+        for phase in other.phase_order:
+            self.add_time(phase, stats['times'][phase])
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time the body of a with statement as part of phase name."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start)
+
+    def as_dict(self):
+        with self.lock:
+            return {'counts': dict(self.counts),
+                    'times': dict(self.times),
+                    'wall_time': time.time() - self.started}
+
+    def summary(self):
+        """Return a human readable table of phase times and counts."""
+        stats = self.as_dict()
+        lines = ["%-20s %12s" % ('phase', 'seconds')]
+        for phase in self.phase_order:
+            lines.append("%-20s %12.3f" % (phase, stats['times'][phase]))
+        lines.append("%-20s %12.3f" % ('total (wall)', stats['wall_time']))
+        lines.append("")
+        lines.append("%-20s %12s" % ('counter', 'count'))
+        for name in COUNTERS:
+            lines.append("%-20s %12d" % (name, stats['counts'][name]))
+        return "\n".join(lines)
+
+    def write_json(self, path):
+        """Save the counts and timings to path as JSON."""
+        with open(path, 'w') as json_file:
+            json.dump(self.as_dict(), json_file, indent=2, sort_keys=True)
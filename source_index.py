@@ -0,0 +1,163 @@
+"""A persistent index of directory listings within a source directory, so that
+repeated searches of the same tree only need to re-list directories which
+have changed since they were last seen. Stored as a SQLite file."""
+
+import os
+import sqlite3
+import threading
+import time
+
+# Listings of directories modified less than this many seconds before they
+# were read aren't trusted on the next run, as a change within the same tick
+# of a coarse mtime wouldn't show up.
+RACY_SECONDS = 2
+
+# Write to disk after this many directories have been listed
+COMMIT_EVERY = 1000
+
+class SourceIndex:
+    """Caches the listing of each directory walked under source, keyed by its
+    path relative to source. Each row records an entry's depth, type and
+    inode; directories which have been listed also record the mtime they had
+    at the time, which is checked before their cached listing is reused.
+    """
+    def __init__(self, index_path, source, lister):
+        """
+        index_path : str : path
+            The SQLite file to keep the index in. Created if need be.
+        source : str : path
+            The directory being indexed
+        lister : function
+            Called as lister(path) to really list a directory, returning
+            (name, is_dir, is_link) tuples - e.g move_by_regex.list_directory
+        """
+        self.index_path = os.path.abspath(index_path)
+        self.source = source
+        self.lister = lister
+        self.lock = threading.Lock()
+        self.uncommitted = 0
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(self.index_path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS entries ("
+                          "path TEXT PRIMARY KEY, "
+                          "parent TEXT, "
+                          "name TEXT, "
+                          "position INTEGER, "
+                          "depth INTEGER, "
+                          "is_dir INTEGER, "
+                          "is_link INTEGER, "
+                          "inode INTEGER, "
+                          "mtime REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS entries_by_parent "
+                          "ON entries (parent, position)")
+        self.conn.commit()
+
+    def relative(self, path):
+        """Return path relative to source, with the source itself as ''."""
+        rel = os.path.relpath(path, self.source)
+        if rel == os.curdir:
+            return ''
+        return rel
+
+    def list_directory(self, path):
+        """A drop-in for move_by_regex.list_directory, which only really lists
+        path if it has changed since the index last saw it."""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return []
+        rel = self.relative(path)
+        with self.lock:
+            row = self.conn.execute("SELECT mtime, inode FROM entries "
+                                    "WHERE path = ?", (rel,)).fetchone()
+            if row is not None and row[0] == st.st_mtime and \
+               row[1] == st.st_ino:
+                self.hits += 1
+                return self.cached_listing(rel)
+        self.misses += 1
+        entries = self.lister(path)
+        self.store_listing(path, rel, st, entries)
+        return entries
+
+    def probe_directory(self, path, names):
+        """Answer a probe for the given names in path from the index, if
+        path's listing is there and still current; otherwise return None so
+        the caller can look for them directly."""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return []
+        rel = self.relative(path)
+        with self.lock:
+            row = self.conn.execute("SELECT mtime, inode FROM entries "
+                                    "WHERE path = ?", (rel,)).fetchone()
+            if row is None or row[0] != st.st_mtime or row[1] != st.st_ino:
+                return None
+            self.hits += 1
+            wanted = set(names)
+            return [e for e in self.cached_listing(rel) if e[0] in wanted]
+
+    def cached_listing(self, rel):
+        rows = self.conn.execute("SELECT name, is_dir, is_link FROM entries "
+                                 "WHERE parent = ? ORDER BY position", (rel,))
+        return [(name, bool(is_dir), bool(is_link))
+                for name, is_dir, is_link in rows]
+
+    def store_listing(self, path, rel, st, entries):
+        """Replace the index's record of a directory's contents."""
+        if rel:
+            depth = len(rel.split(os.sep))
+        else:
+            depth = 0
+        mtime = st.st_mtime
+        if time.time() - mtime < RACY_SECONDS:
+            mtime = None
+        with self.lock:
+            # Subdirectories keep the mtime and inode they were last listed
+            # with, so relisting a parent doesn't throw away its children.
+            old = {}
+            for name, old_path, inode, old_mtime in self.conn.execute(
+                    "SELECT name, path, inode, mtime FROM entries "
+                    "WHERE parent = ?", (rel,)):
+                old[name] = (old_path, inode, old_mtime)
+            rows = []
+            for position, (name, is_dir, is_link) in enumerate(entries):
+                inode, entry_mtime = None, None
+                if is_dir and name in old:
+                    inode, entry_mtime = old[name][1:]
+                rows.append((os.path.join(rel, name), rel, name, position,
+                             depth + 1, int(is_dir), int(is_link), inode,
+                             entry_mtime))
+            names = set(e[0] for e in entries)
+            for name in old:
+                if name not in names:
+                    # Gone, so forget everything that was below it too
+                    old_path = old[name][0]
+                    self.conn.execute("DELETE FROM entries WHERE "
+                                      "substr(path, 1, ?) = ?",
+                                      (len(old_path) + 1, old_path + os.sep))
+            self.conn.execute("DELETE FROM entries WHERE parent = ?", (rel,))
+            self.conn.executemany("INSERT OR REPLACE INTO entries "
+                                  "(path, parent, name, position, depth, "
+                                  "is_dir, is_link, inode, mtime) "
+                                  "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                  rows)
+            self.conn.execute("INSERT OR REPLACE INTO entries "
+                              "(path, parent, name, position, depth, is_dir, "
+                              "is_link, inode, mtime) VALUES "
+                              "(?, (SELECT parent FROM entries WHERE path = ?),"
+                              " ?, (SELECT position FROM entries "
+                              "WHERE path = ?), ?, 1, 0, ?, ?)",
+                              (rel, rel, os.path.basename(rel), rel, depth,
+                               st.st_ino, mtime))
+            self.uncommitted += 1
+            if self.uncommitted >= COMMIT_EVERY:
+                self.conn.commit()
+                self.uncommitted = 0
+
+    def close(self):
+        """Write everything to disk and close the index."""
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
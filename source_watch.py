@@ -0,0 +1,208 @@
+"""Watches a source directory for new entries matching a set of patterns, so
+that a long-running move_by_regex can move new matches as they appear rather
+than searching the whole of source again every few minutes.
+
+Only directories on the path of a live pattern are watched - the same ones
+a search would visit - and each one's listing is remembered, so when it
+changes only the entries which are new are matched. Changes are learnt of
+through inotify where the inotify_simple module is available, and otherwise
+by polling each watched directory's mtime.
+"""
+
+import errno
+import os
+import stat
+import time
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+# Directories modified less than this many seconds before they were listed
+# are listed again on the next poll, as a change within the same tick of a
+# coarse mtime wouldn't show up.
+RACY_SECONDS = 2
+
+class WatchedDir:
+    """What is known of a single watched directory.
+
+      WatchedDir.nodes : the live trie nodes which led to it
+      WatchedDir.names : the names it held when last listed
+      WatchedDir.mtime : its mtime when last listed, or None if it should
+                         be listed again on the next poll regardless
+      WatchedDir.wd    : its inotify watch descriptor, if it has one
+    """
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.names = set()
+        self.mtime = None
+        self.wd = None
+
+class SourceWatch:
+    """Keeps track of every directory under source that patterns could
+    still match below, and reports matches among entries created in them.
+    walk() finds everything already there; each call to poll() after that
+    finds only what has appeared since.
+
+    Results come as (root, dir_matches, file_matches) tuples, as yielded by
+    move_by_regex.walk_source. Not safe to use from several threads at once.
+    """
+    def __init__(self, source, trie, lister, matcher, use_inotify=True):
+        """
+        source : str : path
+            The directory to watch
+        trie : PatternTrie
+            The patterns to match new entries against
+        lister : function
+            Called as lister(path) to list a directory, returning
+            (name, is_dir, is_link) tuples - e.g move_by_regex.list_directory
+        matcher : function
+            Called as matcher(entries, nodes) to match a directory's entries
+            against the trie nodes which led to it, returning (dir_matches,
+            file_matches, to_walk, ...) - e.g move_by_regex.match_entries
+        use_inotify : bool : default True
+            Use inotify to learn of changes, if inotify_simple can be
+            imported. Otherwise every watched directory is polled.
+        """
+        self.source = source
+        self.trie = trie
+        self.lister = lister
+        self.matcher = matcher
+        self.dirs = {}
+        self.by_wd = {}
+        self.inotify = None
+        if use_inotify and inotify_simple is not None:
+            try:
+                self.inotify = inotify_simple.INotify()
+            except OSError:
+                pass
+        if self.inotify is not None:
+            f = inotify_simple.flags
+            self.watch_flags = f.CREATE | f.DELETE | f.MOVED_TO | \
+                               f.MOVED_FROM | f.DELETE_SELF | f.MOVE_SELF
+
+    def walk(self):
+        """Start watching, yielding everything in source which already
+        matches."""
+        for result in self.add(self.source, [self.trie]):
+            yield result
+
+    def poll(self, timeout):
+        """Wait up to timeout seconds for directories to change, then yield
+        matches among the entries they have gained since they were last
+        listed. New directories on the path of a live pattern are watched,
+        and searched in full, as they are found."""
+        changed = self.wait_for_changes(timeout)
+        for path in sorted(changed):
+            if path not in self.dirs:
+                # Gone since, along with a parent
+                continue
+            for result in self.relist(path):
+                yield result
+
+    def wait_for_changes(self, timeout):
+        """Return the paths of watched directories which may have changed,
+        having waited up to timeout seconds for any to do so."""
+        changed = set()
+        if self.inotify is not None:
+            events = self.inotify.read(timeout=int(timeout * 1000))
+            for event in events:
+                if event.mask & inotify_simple.flags.Q_OVERFLOW:
+                    # Events were lost, so anything may have changed
+                    changed.update(self.dirs)
+                elif event.wd in self.by_wd:
+                    changed.add(self.by_wd[event.wd])
+            return changed
+        time.sleep(timeout)
+        for path, d in self.dirs.items():
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                changed.add(path)
+                continue
+            if d.mtime is None or mtime != d.mtime:
+                changed.add(path)
+        return changed
+
+    def add(self, path, nodes):
+        """Watch a directory and everything below it that patterns could
+        match, yielding matches among all of their entries."""
+        d = WatchedDir(nodes)
+        self.dirs[path] = d
+        if self.inotify is not None:
+            try:
+                d.wd = self.inotify.add_watch(path, self.watch_flags)
+            except OSError as e:
+                if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    # Most likely out of watches, so poll instead
+                    self.stop_inotify()
+            else:
+                self.by_wd[d.wd] = path
+        for result in self.relist(path):
+            yield result
+
+    def relist(self, path):
+        """List a watched directory again, yielding matches among the
+        entries it has gained and forgetting those it has lost."""
+        d = self.dirs[path]
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.forget(path)
+            return
+        if not stat.S_ISDIR(st.st_mode):
+            self.forget(path)
+            return
+        # Keep the mtime from before listing, so nothing created during the
+        # listing is missed. inotify reports every change once a directory
+        # is watched, so needs no such care.
+        d.mtime = st.st_mtime
+        if self.inotify is None and time.time() - st.st_mtime < RACY_SECONDS:
+            d.mtime = None
+        entries = self.lister(path)
+        names = set(name for name, is_dir, is_link in entries)
+        for name in d.names - names:
+            # Nothing is watched below an entry that isn't watched itself
+            if os.path.join(path, name) in self.dirs:
+                self.forget(os.path.join(path, name))
+        new = [e for e in entries if e[0] not in d.names]
+        d.names = names
+        if not new:
+            return
+        dir_matches, file_matches, to_walk = self.matcher(new, d.nodes)[:3]
+        yield path, dir_matches, file_matches
+        for name, below in to_walk:
+            below_path = os.path.join(path, name)
+            if below_path not in self.dirs:
+                for result in self.add(below_path, below):
+                    yield result
+
+    def forget(self, path):
+        """Stop watching path, if it is watched, and everything below it."""
+        below = path.rstrip(os.sep) + os.sep
+        for watched in [p for p in self.dirs
+                        if p == path or p.startswith(below)]:
+            d = self.dirs.pop(watched)
+            if d.wd is not None:
+                self.by_wd.pop(d.wd, None)
+                try:
+                    self.inotify.rm_watch(d.wd)
+                except OSError:
+                    # Removed already, along with the directory
+                    pass
+
+    def stop_inotify(self):
+        """Fall back to polling every watched directory."""
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+        self.by_wd = {}
+        for d in self.dirs.values():
+            # Its mtime may be racy, so list it once more to be sure
+            d.wd = None
+            d.mtime = None
+
+    def close(self):
+        self.stop_inotify()
+        self.dirs = {}
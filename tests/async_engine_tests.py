@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+"""
+
+Tests for async_engine, which needs Python 3.6 or later.
+
+"""
+import asyncio
+import os
+import shutil
+import swisspy
+import unittest
+import sys
+
+# Import base script. If you can't, add content root to sys.path
+try:
+    import async_engine
+except ImportError:
+    base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.append(base_dir)
+    import async_engine
+import move_by_regex
+
+class TestAsyncEngine(unittest.TestCase):
+
+    def setUp(self):
+        swisspy_root = swisspy.get_dir_currently_running_in()
+        self.root = swisspy.smooth_join(swisspy_root, '..')
+        self.models = swisspy.smooth_join(self.root, 'models')
+        self.source = swisspy.smooth_join(self.root, 'async_source')
+        self.dest = swisspy.smooth_join(self.root, 'async_dest')
+        self.clear_dirs()
+        shutil.copytree(swisspy.smooth_join(self.models, 'input'),
+                        self.source)
+        os.mkdir(self.dest)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        self.clear_dirs()
+
+    def clear_dirs(self):
+        for d in [self.source, self.dest]:
+            try:
+                shutil.rmtree(d)
+            except OSError:
+                pass
+
+    def test_search_matches_blocking_search(self):
+        patterns = [['*', 'move_me'], ['*', '*', 'regex{.*}'],
+                    ['move_me_too', 'no_move', 'noch_ein_file.txt'],
+                    ['not_there']]
+
+        observed = self.loop.run_until_complete(
+            async_engine.search_source_for_patterns(self.source, patterns))
+
+        expected = move_by_regex.search_source_for_patterns(self.source,
+                                                            patterns)
+        self.assertEqual(observed, expected)
+
+    def test_move_source_moves_everything_found(self):
+        patterns = [['*', 'move_me'], ['move_me']]
+
+        records, result = self.loop.run_until_complete(
+            async_engine.move_source(self.source, self.dest, patterns,
+                                     queue_size=1))
+
+        self.assertEqual([r.to_move for r in records],
+                         list(result['dirs_to_move']))
+        self.assertEqual(len(records), 3)
+        for record in records:
+            self.assertTrue(record.moved)
+            self.assertFalse(os.path.exists(record.to_move))
+        self.assertTrue(os.path.exists(os.path.join(self.dest, 'depth_1',
+                                                    'move_me', 'a_file.txt')))
+
+    def test_cancelling_stops_the_walk_without_leaving_partial_moves(self):
+        patterns = [['*', 'move_me'], ['move_me']]
+        task = self.loop.create_task(
+            async_engine.move_source(self.source, self.dest, patterns,
+                                     queue_size=1))
+        self.loop.call_soon(task.cancel)
+
+        with self.assertRaises(asyncio.CancelledError):
+            self.loop.run_until_complete(task)
+
+        for name in ['depth_1', 'move_me_too']:
+            moved = os.path.join(self.dest, name, 'move_me')
+            left = os.path.join(self.source, name, 'move_me')
+            self.assertNotEqual(os.path.exists(moved), os.path.exists(left))
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
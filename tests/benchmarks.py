@@ -0,0 +1,269 @@
+#!/usr/bin/python
+
+"""
+
+Benchmarks for move-by-regex. Builds a synthetic project tree and pattern
+file in a temporary directory, then times each phase of a run over them and
+reports throughput and peak memory, e.g:
+
+    python benchmarks.py --width 20 --depth 3 --patterns 2000 --workers 4
+
+Pass --processes to see how matching in a pool of processes scales.
+
+Startup of the command line tool is timed too, both for --help and for a run
+with nothing in its pattern file, as it is started many times a day.
+
+"""
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Import base script. If you can't, add content root to sys.path
+try:
+    import move_by_regex
+except ImportError:
+    base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.append(base_dir)
+    import move_by_regex
+
+# Fail rather than report timings if fewer than this fraction of the
+# patterns generated are left to search for once redundant ones are removed
+MIN_LIVE_FRACTION = 0.1
+
+def init_args():
+    """ Initialise command line arguments"""
+    p = argparse.ArgumentParser(
+        description="Time move_by_regex against a synthetic project tree")
+    p.add_argument('--width', metavar='N', type=int, default=10,
+                   help="Number of subdirectories in each directory")
+    p.add_argument('--depth', metavar='N', type=int, default=3,
+                   help="Number of directory levels in the tree")
+    p.add_argument('--files', metavar='N', type=int, default=2,
+                   help="Number of files in each leaf directory")
+    p.add_argument('--patterns', metavar='N', type=int, default=500,
+                   help="Number of lines in the pattern file")
+    p.add_argument('--mix', metavar='L,G,R', type=str, default='6,1,3',
+                   help="Relative weights of literal, glob and regex pieces "
+                        "in generated patterns")
+    p.add_argument('--missing', metavar='FRACTION', type=float, default=0.1,
+                   help="Fraction of patterns which match nothing")
+    p.add_argument('--workers', metavar='N', type=int, default=1,
+                   help="Number of threads to search with")
+    p.add_argument('--processes', metavar='N', type=int, default=1,
+                   help="Number of processes to match regex pieces in")
+    p.add_argument('--startup-runs', metavar='N', type=int, default=10,
+                   dest='startup_runs',
+                   help="Number of times to start the command line tool "
+                        "when timing startup")
+    p.add_argument('--seed', metavar='N', type=int, default=0,
+                   help="Seed for generating the tree and patterns")
+    p.add_argument('--keep', metavar='path', type=str, default=None,
+                   help="Build the tree here, and leave it in place")
+    return p.parse_args()
+
+def dir_name(level, i):
+    """Names look like job folders at the deepest level, as on Projects:
+
+    >>> dir_name(0, 3)
+    'd0_3'
+    >>> dir_name(2, 12)
+    '4000012'
+    """
+    if level >= 2:
+        return '4%06d' % i
+    return 'd%d_%d' % (level, i)
+
+def make_tree(root, width, depth, files):
+    """Build a tree width directories wide and depth levels deep under root,
+    with files in each leaf directory. Returns the number of entries made."""
+    count = 0
+    parents = [root]
+    for level in range(depth):
+        children = []
+        for parent in parents:
+            for i in range(width):
+                child = os.path.join(parent, dir_name(level, i))
+                os.mkdir(child)
+                children.append(child)
+        count += len(children)
+        parents = children
+    for parent in parents:
+        for i in range(files):
+            with open(os.path.join(parent, 'file_%d.txt' % i), 'w') as f:
+                f.write('x' * 1024)
+        count += files
+    return count
+
+def make_patterns(count, width, depth, mix, missing, rng):
+    """Return count pattern lines for a tree made by make_tree, with each
+    piece chosen as a literal, glob or regex according to the weights in
+    mix. A fraction missing of them won't match anything.
+
+    Every pattern reaches down to the deepest level of directories, as a
+    pattern for a job folder would, and only pieces between the first and
+    last can be globs. Each regex matches just the name it stands in for.
+    Otherwise a short pattern such as a lone * would cover all the others,
+    leaving nothing to search for but a single level of the tree.
+    """
+    literal, glob, regex = mix
+    lines = []
+    for n in range(count):
+        pieces = []
+        for level in range(depth):
+            name = dir_name(level, rng.randrange(width))
+            choice = rng.uniform(0, literal + glob + regex)
+            if choice < literal or level == 0:
+                pieces.append(name)
+            elif choice < literal + glob and level < depth - 1:
+                pieces.append('*')
+            elif choice < literal + glob:
+                pieces.append(name)
+            else:
+                pieces.append('regex{%s[%s]$}' % (name[:-1], name[-1]))
+        if rng.random() < missing:
+            pieces[-1] = 'missing_%d' % n
+        lines.append('/'.join(pieces))
+    return lines
+
+def run_cli(arguments, runs):
+    """Start move_by_regex.py runs times with the given arguments, as cron or
+    a dispatcher would, discarding its output."""
+    script = os.path.splitext(os.path.abspath(move_by_regex.__file__))[0]
+    with open(os.devnull, 'w') as devnull:
+        for n in range(runs):
+            subprocess.call([sys.executable, script + '.py'] + arguments,
+                            stdout=devnull, stderr=devnull)
+
+def peak_memory_mb():
+    """Peak resident memory of this process so far, in MB."""
+    if resource is None:
+        return float('nan')
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / (1024.0 * 1024)
+    return peak / 1024.0
+
+def time_phase(results, name, function, units, unit_name):
+    """Run function, adding a row to results with its wall time, throughput
+    in units of unit_name per second, and peak memory afterwards. Returns
+    whatever function returns."""
+    start = time.time()
+    out = function()
+    elapsed = time.time() - start
+    if callable(units):
+        units = units(out)
+    if elapsed:
+        rate = units / elapsed
+    else:
+        rate = float('inf')
+    results.append({'phase': name,
+                    'seconds': elapsed,
+                    'count': units,
+                    'rate': rate,
+                    'unit': unit_name,
+                    'peak_mb': peak_memory_mb()})
+    return out
+
+def report(results):
+    print('%-12s %10s %10s %14s %-10s %9s' % ('phase', 'seconds', 'count',
+                                            'rate', 'unit', 'peak MB'))
+    for r in results:
+        print('%-12s %10.3f %10d %14.1f %-10s %9.1f' % (r['phase'],
+                                                      r['seconds'],
+                                                      r['count'],
+                                                      r['rate'],
+                                                      r['unit'] + '/sec',
+                                                      r['peak_mb']))
+
+def run_benchmarks(args):
+    rng = random.Random(args.seed)
+    mix = [float(m) for m in args.mix.split(',')]
+    if args.keep:
+        work_dir = args.keep
+        if not os.path.exists(work_dir):
+            os.makedirs(work_dir)
+    else:
+        work_dir = tempfile.mkdtemp(prefix='mbr_bench_')
+    source = os.path.join(work_dir, 'source')
+    dest = os.path.join(work_dir, 'dest')
+    paths_file = os.path.join(work_dir, 'paths.txt')
+    empty_paths_file = os.path.join(work_dir, 'empty_paths.txt')
+    log_file = os.path.join(work_dir, 'log.txt')
+    results = []
+    try:
+        for d in [source, dest]:
+            if os.path.exists(d):
+                shutil.rmtree(d)
+            os.mkdir(d)
+        with open(empty_paths_file, 'w') as f:
+            f.write('# Nothing to move\n')
+        time_phase(results, 'startup -h',
+                   lambda: run_cli(['-h'], args.startup_runs),
+                   args.startup_runs, 'runs')
+        time_phase(results, 'startup nil',
+                   lambda: run_cli(['-s', source, '-d', dest,
+                                    '-p', empty_paths_file, '-l', log_file],
+                                   args.startup_runs),
+                   args.startup_runs, 'runs')
+        entries = time_phase(results, 'build tree',
+                             lambda: make_tree(source, args.width,
+                                               args.depth, args.files),
+                             lambda n: n, 'entries')
+        lines = make_patterns(args.patterns, args.width, args.depth, mix,
+                              args.missing, rng)
+        with open(paths_file, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+        paths = time_phase(results, 'read',
+                           lambda: move_by_regex.get_lines(paths_file),
+                           len(lines), 'patterns')
+        patterns = time_phase(results, 'compile',
+                              lambda: move_by_regex.compile_patterns(
+                                  move_by_regex.get_patterns(paths)),
+                              len(lines), 'patterns')
+        pattern_set = time_phase(results, 'redundancy',
+                                 lambda: move_by_regex.PatternSet(patterns),
+                                 len(lines), 'patterns')
+        live = len(pattern_set.to_check)
+        if live < MIN_LIVE_FRACTION * len(lines):
+            raise SystemExit("Only {} of the {} patterns generated are left "
+                             "once redundant ones are removed, so the search "
+                             "would measure little; use a wider or deeper "
+                             "tree, or fewer patterns".format(live,
+                                                              len(lines)))
+        stats = move_by_regex.run_stats.RunStats()
+        # Searching for the PatternSet, so redundancy isn't timed again
+        found = time_phase(results, 'search',
+                           lambda: move_by_regex.search_source_for_patterns(
+                               source, pattern_set, workers=args.workers,
+                               stats=stats, processes=args.processes),
+                           lambda found: stats.counts['entries_examined'],
+                           'entries')
+        to_move = found['dirs_to_move'] + found['files_to_move']
+        known_dirs = set()
+        time_phase(results, 'move',
+                   lambda: [move_by_regex.move_creating_intermediaries(
+                                source, path, dest, known_dirs)
+                            for path in to_move],
+                   len(to_move), 'moves')
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir)
+    return results
+
+def main():
+    args = init_args()
+    report(run_benchmarks(args))
+
+if __name__ == '__main__':
+    main()
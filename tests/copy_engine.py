@@ -0,0 +1 @@
+../copy_engine.py
\ No newline at end of file
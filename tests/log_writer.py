@@ -0,0 +1 @@
+../log_writer.py
\ No newline at end of file
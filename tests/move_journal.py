@@ -0,0 +1 @@
+../move_journal.py
\ No newline at end of file
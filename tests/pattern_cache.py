@@ -0,0 +1 @@
+../pattern_cache.py
\ No newline at end of file
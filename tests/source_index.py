@@ -0,0 +1 @@
+../source_index.py
\ No newline at end of file
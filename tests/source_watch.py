@@ -0,0 +1 @@
+../source_watch.py
\ No newline at end of file
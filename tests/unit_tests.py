@@ -1,13 +1,25 @@
 #!/usr/bin/python
 
+import errno
+import gzip
+import json
 import logging
 import os
 import shutil
+import socket
+import stat
 import swisspy
 import subprocess
 import unittest
 import sys
+import time
+import copy_engine
 import log_messages
+import log_writer
+import move_journal
+import pattern_cache
+import source_index
+import source_watch
 
 # Import base script. If you can't, add content root to sys.path
 try:
@@ -79,6 +91,97 @@ class TestSimpleTransfer(unittest.TestCase):
         desired = ['a_path']
         self.assertEqual(observed, desired)
 
+    def test_patterns_read_from_gzip_without_duplicates(self):
+        gz_path = os.path.join(self.logs, 'paths.txt.gz')
+        gz_file = gzip.open(gz_path, 'wb')
+        gz_file.write(b"# A comment\nmove_me\n\n*/regex{move_.*}\nmove_me\n")
+        gz_file.close()
+        with open(self.input_file, 'w') as input_file:
+            input_file.write("move_me\n*/regex{move_.*}\n")
+
+        patterns, digest = move_by_regex.read_patterns(gz_path)
+        plain_patterns, plain_digest = move_by_regex.read_patterns(
+            self.input_file)
+
+        self.assertEqual(patterns, [['move_me'], ['*', 'regex{move_.*}']])
+        self.assertEqual(patterns[1].pieces[1].type, 'regex')
+        self.assertEqual(patterns, plain_patterns)
+        self.assertEqual(digest, plain_digest)
+
+    def test_redundancy_found_with_the_trie_patterns_were_read_into(self):
+        with open(self.input_file, 'w') as input_file:
+            input_file.write("move_me/a_file\n*/regex{move_.*}\nmove_me\n"
+                             "depth_1/move_me\nmove_me\nbad/regex{(}\n")
+        trie = move_by_regex.PatternTrie()
+        patterns, digest = move_by_regex.read_patterns(self.input_file,
+                                                       trie=trie)
+
+        from_trie = move_by_regex.PatternSet(patterns, trie=trie)
+        fresh = move_by_regex.PatternSet(patterns)
+
+        self.assertEqual(len(patterns), 5)
+        self.assertEqual(from_trie.to_check, [['move_me'],
+                                              ['*', 'regex{move_.*}']])
+        self.assertEqual(from_trie.to_check, fresh.to_check)
+        self.assertEqual(from_trie.redundant, fresh.redundant)
+        self.assertEqual(from_trie.invalid, [['bad', 'regex{(}']])
+
+    def test_pattern_cache_skips_checking_unchanged_patterns(self):
+        with open(self.input_file, 'w') as input_file:
+            input_file.write("move_me\nmove_me/a_file\n*/regex{move_.*}\n")
+        cache = pattern_cache.PatternCache(os.path.join(self.logs, 'cache'))
+        main_logger = logging.getLogger('mbr.main')
+        operation = move_by_regex.load_patterns
+
+        first = operation(self.input_file, main_logger, self.log_text,
+                          move_by_regex.run_stats.RunStats(), cache=cache)
+        real_get_redundant_patterns = move_by_regex.get_redundant_patterns
+        def no_redundancy_check(from_list):
+            self.fail("Patterns were checked for redundancy again")
+        move_by_regex.get_redundant_patterns = no_redundancy_check
+        self.addCleanup(setattr, move_by_regex, 'get_redundant_patterns',
+                        real_get_redundant_patterns)
+        second = operation(self.input_file, main_logger, self.log_text,
+                           move_by_regex.run_stats.RunStats(), cache=cache)
+
+        self.assertEqual(second.redundant, [['move_me', 'a_file']])
+        self.assertEqual(second.redundant, first.redundant)
+        self.assertEqual(second.to_check, first.to_check)
+        self.assertEqual(
+            move_by_regex.search_source_for_patterns(self.source, second),
+            move_by_regex.search_source_for_patterns(self.source, first))
+
+    def test_pattern_cache_evicts_least_recently_used(self):
+        cache = pattern_cache.PatternCache(os.path.join(self.logs, 'cache'))
+        cache.store('old', 'digest', [['move_me']], [])
+        cache.max_bytes = os.path.getsize(cache.entry_path('old'))
+        os.utime(cache.entry_path('old'), (1000000000, 1000000000))
+
+        cache.store('new', 'digest', [['move_me']], [])
+
+        self.assertEqual(cache.load('old'), None)
+        self.assertEqual(cache.load('new'), ('digest', [['move_me']], []))
+
+    def test_log_written_in_batches_and_compressed(self):
+        gz_path = os.path.join(self.logs, 'batched_log.txt.gz')
+        handler = log_writer.BufferedFileHandler(gz_path, 'w',
+                                                 flush_seconds=60)
+        logger = logging.getLogger('mbr.test_log_writer')
+        logger.propagate = False
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+
+        for n in range(3):
+            logger.warning("Record %d", n)
+        handler.flush()
+        logger.warning("Record 3")
+        handler.close()
+
+        gz_file = gzip.open(gz_path, 'rb')
+        written = gz_file.read()
+        gz_file.close()
+        self.assertEqual(written, b"Record 0\nRecord 1\nRecord 2\nRecord 3\n")
+
     def set_up_spacer_test(self):
         os.mkdir(swisspy.smooth_join(self.source,'spacer'))
         os.mkdir(swisspy.smooth_join(self.source,'move_only_from_spacer'))
@@ -138,6 +241,300 @@ class TestSimpleTransfer(unittest.TestCase):
 
         self.assertEqual(observed,desired)
 
+    def test_search_source_only_matches_full_pattern_prefix(self):
+        self.set_up_spacer_test()
+        operation = move_by_regex.search_source_for_patterns
+        observed = operation(self.source,
+                             [['spacer', 'move_only_from_spacer'],
+                              ['depth_1', 'regex{move_.*}']])
+
+        desired_dirs = [os.path.join(self.source, 'depth_1', 'move_me'),
+                        os.path.join(self.source, 'spacer',
+                                     'move_only_from_spacer')]
+        self.assertEqual(sorted(observed['dirs_to_move']), desired_dirs)
+        self.assertEqual(observed['paths_not_matched'], [])
+
+    def test_invalid_regex_reported_before_search(self):
+        operation = move_by_regex.search_source_for_patterns
+        observed = operation(self.source,
+                             [['no_such_dir', 'regex{[unclosed}'],
+                              ['move_me']])
+
+        self.assertEqual(observed['invalid_regex'], ['[unclosed'])
+        self.assertEqual(observed['paths_not_matched'], [])
+        self.assertEqual(observed['dirs_to_move'],
+                         [os.path.join(self.source, 'move_me')])
+
+    def record_listings(self):
+        """Replace move_by_regex.list_directory with a version which records
+        the directories it is asked to list."""
+        listed = []
+        real_list_directory = move_by_regex.list_directory
+        def recording_list_directory(path):
+            listed.append(os.path.relpath(path, self.source))
+            return real_list_directory(path)
+        move_by_regex.list_directory = recording_list_directory
+        self.addCleanup(setattr, move_by_regex, 'list_directory',
+                        real_list_directory)
+        return listed
+
+    def test_listing_without_scandir_takes_one_stat_per_entry(self):
+        listing = os.path.join(self.source, 'listing')
+        os.mkdir(listing)
+        os.mkdir(os.path.join(listing, 'a_dir'))
+        open(os.path.join(listing, 'a_file'), 'w').close()
+        os.symlink('a_dir', os.path.join(listing, 'dir_link'))
+        os.symlink('a_file', os.path.join(listing, 'file_link'))
+        self.addCleanup(setattr, move_by_regex, 'scandir',
+                        move_by_regex.scandir)
+        move_by_regex.scandir = None
+        stats = []
+        def counting(name, real_stat):
+            def counting_stat(path, *args, **kwargs):
+                stats.append((name, os.path.basename(path)))
+                return real_stat(path, *args, **kwargs)
+            return counting_stat
+        for name in ['stat', 'lstat']:
+            self.addCleanup(setattr, os, name, getattr(os, name))
+            setattr(os, name, counting(name, getattr(os, name)))
+
+        entries = move_by_regex.list_directory(listing)
+
+        self.assertEqual(sorted(entries),
+                         [('a_dir', True, False), ('a_file', False, False),
+                          ('dir_link', True, True),
+                          ('file_link', False, True)])
+        self.assertEqual(sorted(stats),
+                         [('lstat', 'a_dir'), ('lstat', 'a_file'),
+                          ('lstat', 'dir_link'), ('lstat', 'file_link'),
+                          ('stat', 'dir_link'), ('stat', 'file_link')])
+
+    def test_walk_only_lists_directories_patterns_can_reach(self):
+        listed = self.record_listings()
+        operation = move_by_regex.search_source_for_patterns
+        observed = operation(self.source, [['regex{depth_[12]}', 'move_me']])
+
+        self.assertEqual(observed['dirs_to_move'],
+                         [os.path.join(self.source, 'depth_1', 'move_me')])
+        self.assertEqual(sorted(listed), ['.'])
+
+    def test_walk_probes_literal_paths_without_listing(self):
+        listed = self.record_listings()
+        operation = move_by_regex.search_source_for_patterns
+        observed = operation(self.source,
+                             [['depth_2', 'spacer_1', 'move_me'],
+                              ['move_me_too', 'not_there']])
+
+        self.assertEqual(observed['dirs_to_move'],
+                         [os.path.join(self.source, 'depth_2', 'spacer_1',
+                                       'move_me')])
+        self.assertEqual(observed['paths_not_matched'],
+                         ['move_me_too/not_there'])
+        self.assertEqual(listed, [])
+
+    def test_walk_never_matches_source_or_outside_it(self):
+        operation = move_by_regex.search_source_for_patterns
+        observed = operation(self.source,
+                             [['.'], ['..', 'input', 'regex{move_.*}'],
+                              ['..', 'input', 'depth_1', 'move_me']])
+
+        self.assertEqual(observed['dirs_to_move'], [])
+        self.assertEqual(observed['files_to_move'], [])
+        self.assertEqual(len(observed['paths_not_matched']), 3)
+
+    def test_walk_starts_from_the_end_of_shared_literal_prefixes(self):
+        os.symlink(os.path.join(self.source, 'depth_2'),
+                   os.path.join(self.source, 'linked'))
+        listed = self.record_listings()
+        operation = move_by_regex.search_source_for_patterns
+        observed = operation(self.source,
+                             [['depth_3', 'spacer_1', 'spacer_2',
+                               'regex{move.*}'],
+                              ['depth_2', 'spacer_1', '*'],
+                              ['linked', 'spacer_1', '*'],
+                              ['depth_1', 'missing', '*']])
+
+        self.assertEqual(observed['dirs_to_move'],
+                         [os.path.join(self.source, 'depth_2', 'spacer_1',
+                                       'move_me'),
+                          os.path.join(self.source, 'depth_3', 'spacer_1',
+                                       'spacer_2', 'move_me')])
+        self.assertEqual(sorted(observed['paths_not_matched']),
+                         ['depth_1/missing/*', 'linked/spacer_1/*'])
+        self.assertEqual(listed, [os.path.join('depth_2', 'spacer_1'),
+                                  os.path.join('depth_3', 'spacer_1',
+                                               'spacer_2')])
+
+    def test_parallel_search_matches_serial_search(self):
+        self.set_up_spacer_test()
+        patterns = [['*', 'move_me'], ['*', '*', 'regex{.*}'],
+                    ['move_me_too', 'no_move', 'noch_ein_file.txt']]
+        operation = move_by_regex.search_source_for_patterns
+
+        serial = operation(self.source, patterns)
+        parallel = operation(self.source, patterns, workers=4)
+
+        self.assertTrue(serial['dirs_to_move'])
+        self.assertTrue(serial['files_to_move'])
+        self.assertEqual(serial, parallel)
+
+    def test_stats_count_the_regex_matches_run(self):
+        stats = move_by_regex.run_stats.RunStats()
+        # The first two are combined into one regex; the group keeps the
+        # third apart
+        move_by_regex.search_source_for_patterns(
+            self.source, [['regex{move_.*}'], [r'regex{depth_\d}'],
+                          ['regex{(sp)acer}']], stats=stats)
+
+        self.assertEqual(stats.counts['regex_evaluations'],
+                         2 * len(os.listdir(self.source)))
+
+    def test_parallel_walk_stays_a_bounded_distance_ahead(self):
+        for i in range(50):
+            os.makedirs(os.path.join(self.source, 'wide', 'dir_%d' % i,
+                                     'move_me'))
+        trie = move_by_regex.PatternTrie([['wide', '*', 'move_me']])
+        held = []
+        real_submit = move_by_regex.ParallelScanner.submit
+        def counting_submit(scanner, root, nodes):
+            held.append(len(scanner.results) + scanner.work.qsize())
+            real_submit(scanner, root, nodes)
+        move_by_regex.ParallelScanner.submit = counting_submit
+        self.addCleanup(setattr, move_by_regex.ParallelScanner, 'submit',
+                        real_submit)
+
+        walked = []
+        for root, dir_matches, file_matches in move_by_regex.walk_source(
+                self.source, trie, workers=2):
+            if not walked:
+                # Give the workers time to run ahead, if they would
+                time.sleep(0.2)
+            walked.append(root)
+
+        self.assertEqual(len(walked), 51)
+        self.assertTrue(max(held) <= 2 * move_by_regex.SCAN_AHEAD)
+
+    def test_matching_in_processes_matches_serial_search(self):
+        self.set_up_spacer_test()
+        patterns = [['*', 'regex{move_.*}'],
+                    [r'regex{spacer|depth_\d}', 'move_only_from_spacer'],
+                    [r'regex{depth_[23]}', 'spacer_1',
+                     r'regex{spacer_\d}', 'regex{move_me$}'],
+                    ['move_me_too', 'no_move', 'noch_ein_file.txt']]
+        operation = move_by_regex.search_source_for_patterns
+        pool_calls = []
+        real_children_matching = move_by_regex.MatchPool.children_matching
+        def counting_children_matching(pool, nodes, names):
+            pool_calls.append(names)
+            return real_children_matching(pool, nodes, names)
+        move_by_regex.MatchPool.children_matching = counting_children_matching
+        self.addCleanup(setattr, move_by_regex.MatchPool,
+                        'children_matching', real_children_matching)
+        # Send even these small listings to the pool
+        self.addCleanup(setattr, move_by_regex, 'POOL_MIN_NAMES',
+                        move_by_regex.POOL_MIN_NAMES)
+        move_by_regex.POOL_MIN_NAMES = 1
+
+        serial = operation(self.source, patterns)
+        self.assertEqual(pool_calls, [])
+        in_processes = operation(self.source, patterns, processes=2)
+
+        self.assertEqual(sorted(serial['dirs_to_move']),
+                         [os.path.join(self.source, *p) for p in
+                          [['depth_1', 'move_me'],
+                           ['depth_3', 'spacer_1', 'spacer_2', 'move_me'],
+                           ['move_me_too', 'move_me'],
+                           ['spacer', 'move_only_from_spacer']]])
+        self.assertEqual(serial, in_processes)
+        # The root's listing, among others, was matched in the pool
+        self.assertIn(sorted(os.listdir(self.source)),
+                      [sorted(names) for names in pool_calls])
+
+    def test_iter_source_matches_yields_typed_events(self):
+        operation = move_by_regex.iter_source_matches
+        events = operation(self.source,
+                           [['regex{(}'], ['depth_1', 'move_me'],
+                            ['depth_1', 'move_me', 'a_file.txt'],
+                            ['nowhere']])
+
+        observed = [(e.type, e.path, '/'.join(e.pattern)) for e in events]
+
+        move_me = os.path.join(self.source, 'depth_1', 'move_me')
+        desired = [('invalid_regex', None, 'regex{(}'),
+                   ('redundant', None, 'depth_1/move_me/a_file.txt'),
+                   ('dir', move_me, 'depth_1/move_me'),
+                   ('satisfied', None, 'depth_1/move_me'),
+                   ('not_matched', None, 'nowhere')]
+        self.assertEqual(observed, desired)
+
+    def test_source_index_only_relists_changed_directories(self):
+        # Back-date the source, so its listings are old enough to trust
+        for root, dirs, files in os.walk(self.source):
+            os.utime(root, (1000000000, 1000000000))
+        index_path = os.path.join(self.dest, 'index.sqlite')
+        patterns = [['*', 'regex{move_me$}'], ['move_me_too', 'regex{.*}']]
+        operation = move_by_regex.search_source_for_patterns
+
+        first_index = source_index.SourceIndex(index_path, self.source,
+                                               move_by_regex.list_directory)
+        first = operation(self.source, patterns, index=first_index)
+        first_index.close()
+        os.mkdir(os.path.join(self.source, 'depth_3', 'move_me'))
+        second_index = source_index.SourceIndex(index_path, self.source,
+                                                move_by_regex.list_directory)
+        listed = self.record_listings()
+        second_index.lister = move_by_regex.list_directory
+        second = operation(self.source, patterns, index=second_index)
+        second_index.close()
+
+        self.assertEqual(listed, ['depth_3'])
+        self.assertEqual(sorted(second['dirs_to_move']),
+                         sorted(first['dirs_to_move'] +
+                                [os.path.join(self.source, 'depth_3',
+                                              'move_me')]))
+
+    def test_watch_only_matches_new_entries(self):
+        patterns = move_by_regex.PatternSet([['*', 'move_me'],
+                                             ['*', '*', 'regex{.*_me}']])
+        already_there = move_by_regex.search_source_for_patterns(self.source,
+                                                                 patterns)
+        watch = source_watch.SourceWatch(self.source, patterns.trie,
+                                         move_by_regex.list_directory,
+                                         move_by_regex.match_entries,
+                                         use_inotify=False)
+        def matched(results):
+            return sorted(os.path.join(root, name)
+                          for root, dir_matches, file_matches in results
+                          for name, pattern in dir_matches + file_matches)
+
+        first = matched(watch.walk())
+        os.makedirs(os.path.join(self.source, 'new_job', 'move_me'))
+        os.makedirs(os.path.join(self.source, 'depth_3', 'new', 'take_me'))
+        second = matched(watch.poll(0))
+        third = matched(watch.poll(0))
+        watch.close()
+
+        self.assertEqual(first, sorted(already_there['dirs_to_move']))
+        self.assertEqual(second,
+                         [os.path.join(self.source, 'depth_3', 'new',
+                                       'take_me'),
+                          os.path.join(self.source, 'new_job', 'move_me')])
+        self.assertEqual(third, [])
+
+    def test_watch_source_moves_what_is_already_there(self):
+        self.set_up_spacer_test()
+        main_logger = logging.getLogger('mbr.main')
+        move_by_regex.watch_source(self.source, self.dest,
+                                   [['*', 'move_only_from_spacer']],
+                                   main_logger, self.log_text,
+                                   move_by_regex.run_stats.RunStats(),
+                                   interval=0, polls=1)
+
+        self.assertTrue(os.path.isdir(os.path.join(self.dest, 'spacer',
+                                                   'move_only_from_spacer')))
+        self.assertTrue(os.path.isdir(os.path.join(self.source,
+                                                   'move_only_from_spacer')))
+
     def test_move_a_directory_from_the_root(self):
         os.mkdir(os.path.join(self.desired_output, 'move_me'))
         test_input = 'move_me'
@@ -193,6 +590,364 @@ class TestSimpleTransfer(unittest.TestCase):
         self.assertIn(self.log_text.unmatched_header, self.get_log_contents())
         self.assertIn('emperor_zibzob', self.get_log_contents())
 
+    def test_move_across_devices_copies_then_removes_source(self):
+        to_move = os.path.join(self.source, 'move_me_too')
+        os.symlink('no_move', os.path.join(to_move, 'a_link'))
+        os.utime(os.path.join(to_move, 'a_file_a_fourth_time.txt'),
+                 (1000000000, 1000000000))
+        expected_size = copy_engine.content_size(to_move)
+        stats = move_by_regex.run_stats.RunStats()
+
+        move_by_regex.move_item(to_move, self.dest, same_device=False,
+                                stats=stats)
+
+        moved = os.path.join(self.dest, 'move_me_too')
+        self.assertFalse(os.path.exists(to_move))
+        self.assertEqual(os.readlink(os.path.join(moved, 'a_link')),
+                         'no_move')
+        self.assertEqual(os.stat(os.path.join(
+            moved, 'a_file_a_fourth_time.txt')).st_mtime, 1000000000)
+        self.assertEqual(copy_engine.content_size(moved), expected_size)
+        self.assertEqual(stats.counts['bytes_copied'], expected_size)
+
+    def test_rename_refused_across_devices_falls_back_to_copying(self):
+        to_move = os.path.join(self.source, 'move_me_too')
+        real_rename = os.rename
+        def cross_device_rename(src, dst):
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+        os.rename = cross_device_rename
+        self.addCleanup(setattr, os, 'rename', real_rename)
+
+        move_by_regex.move_item(to_move, self.dest, same_device=True)
+
+        self.assertFalse(os.path.exists(to_move))
+        self.assertTrue(os.path.exists(os.path.join(self.dest, 'move_me_too',
+                                                    'no_move')))
+
+    def test_move_across_devices_remakes_fifos_and_refuses_sockets(self):
+        to_move = os.path.join(self.source, 'move_me_too')
+        os.mkfifo(os.path.join(to_move, 'a_fifo'))
+
+        move_by_regex.move_item(to_move, self.dest, same_device=False)
+
+        moved = os.path.join(self.dest, 'move_me_too')
+        self.assertTrue(stat.S_ISFIFO(
+            os.lstat(os.path.join(moved, 'a_fifo')).st_mode))
+
+        to_move = os.path.join(self.source, 'move_me')
+        a_socket = socket.socket(socket.AF_UNIX)
+        self.addCleanup(a_socket.close)
+        a_socket.bind(os.path.join(to_move, 'a_socket'))
+
+        with self.assertRaises(copy_engine.CopyError):
+            move_by_regex.move_item(to_move, self.dest, same_device=False)
+
+        self.assertTrue(os.path.exists(os.path.join(to_move, 'a_socket')))
+        self.assertFalse(os.path.exists(os.path.join(self.dest, 'move_me')))
+
+    def test_short_copy_leaves_source_in_place(self):
+        to_move = os.path.join(self.source, 'move_me_too')
+        real_copy_file = copy_engine.copy_file
+        def short_copy_file(src, dst):
+            copied = real_copy_file(src, dst)
+            with open(dst, 'a') as f:
+                f.write('extra')
+            return copied
+        copy_engine.copy_file = short_copy_file
+        self.addCleanup(setattr, copy_engine, 'copy_file', real_copy_file)
+
+        with self.assertRaises(copy_engine.CopyError):
+            move_by_regex.move_item(to_move, self.dest, same_device=False)
+
+        self.assertTrue(os.path.exists(os.path.join(to_move, 'no_move')))
+        self.assertFalse(os.path.exists(os.path.join(self.dest,
+                                                     'move_me_too')))
+
+    def test_move_executor_records_each_item(self):
+        os.mkdir(os.path.join(self.dest, 'move_me'))
+        to_move = [os.path.join(self.source, 'move_me'),
+                   os.path.join(self.source, 'depth_1', 'move_me'),
+                   os.path.join(self.source, 'move_me_too', 'no_move')]
+        executor = move_by_regex.MoveExecutor(self.source, self.dest,
+                                              per_device=3)
+        records = [executor.submit(path, 'directories') for path in to_move]
+
+        executor.wait()
+
+        self.assertEqual([r.to_move for r in records], to_move)
+        self.assertEqual([r.moved for r in records],
+                         [[], [['depth_1', 'move_me']],
+                          [['move_me_too', 'no_move']]])
+        self.assertTrue(os.path.isdir(os.path.join(self.source, 'move_me')))
+        self.assertTrue(os.path.isdir(os.path.join(self.dest, 'depth_1',
+                                                   'move_me')))
+
+    def test_move_executor_waits_for_room_and_spools_successes(self):
+        to_move = [os.path.join(self.source, 'move_me'),
+                   os.path.join(self.source, 'depth_1', 'move_me'),
+                   os.path.join(self.source, 'move_me_too', 'no_move')]
+        successes = move_by_regex.SuccessLog()
+        executor = move_by_regex.MoveExecutor(self.source, self.dest,
+                                              successes=successes,
+                                              queue_size=1)
+        for path in to_move:
+            executor.submit(path, 'directories')
+        executor.wait()
+        handler = logging.FileHandler(self.log_file_path)
+        main_logger = logging.getLogger('mbr.main')
+        main_logger.addHandler(handler)
+        self.addCleanup(main_logger.removeHandler, handler)
+        self.addCleanup(main_logger.setLevel, main_logger.level)
+        self.addCleanup(setattr, main_logger, 'propagate', True)
+        main_logger.setLevel(logging.INFO)
+        main_logger.propagate = False
+
+        successes.log(self.source, self.dest, main_logger, self.log_text)
+        handler.close()
+
+        header = self.log_text.success_story.format(type='directories',
+                                                    source=self.source,
+                                                    dest=self.dest)
+        self.assertEqual(self.get_log_contents().splitlines(),
+                         [header, '\tmove_me', '\tdepth_1/move_me',
+                          '\tmove_me_too/no_move'])
+
+    def test_move_creating_intermediaries_renames_on_same_device(self):
+        to_move = os.path.join(self.source, 'depth_2', 'spacer_1', 'move_me')
+        inode = os.stat(to_move).st_ino
+        known_dirs = set()
+
+        moved = move_by_regex.move_creating_intermediaries(self.source,
+                                                           to_move,
+                                                           self.dest,
+                                                           known_dirs)
+
+        self.assertEqual(moved, [['depth_2', 'spacer_1', 'move_me']])
+        self.assertEqual(known_dirs,
+                         set([os.path.join(self.dest, 'depth_2'),
+                              os.path.join(self.dest, 'depth_2', 'spacer_1')]))
+        moved_to = os.path.join(self.dest, 'depth_2', 'spacer_1', 'move_me')
+        self.assertEqual(os.stat(moved_to).st_ino, inode)
+
+    def test_run_stats_logged_and_written_as_json(self):
+        stats_file = os.path.join(self.logs, 'stats.json')
+        with open(self.input_file, 'w') as input_file:
+            input_file.write('*/move_me\nmove_me_too/regex{no_.*}')
+
+        move_by_regex.move_by_regex(self.source, self.dest, self.input_file,
+                                    self.log_file_path,
+                                    stats_file=stats_file)
+
+        with open(stats_file) as f:
+            stats = json.load(f)
+        self.assertEqual(stats['counts']['moves'], 3)
+        self.assertEqual(stats['counts']['errors'], 0)
+        self.assertEqual(stats['counts']['dirs_listed'], 2)
+        for phase in ['parse', 'redundancy', 'walk', 'match', 'move']:
+            self.assertIn(phase, stats['times'])
+        self.assertIn(self.log_text.stats_header, self.get_log_contents())
+
+    def test_resume_finishes_interrupted_moves_without_searching(self):
+        journal_path = os.path.join(self.logs, 'journal.txt')
+        journal = move_journal.MoveJournal(journal_path, self.source,
+                                           self.dest)
+        copied = os.path.join(self.source, 'depth_1', 'move_me')
+        started = os.path.join(self.source, 'move_me')
+        finished = os.path.join(self.source, 'move_me_too', 'no_move')
+        for path in [copied, started, finished]:
+            journal.record(path, 'planned', 'directories')
+        # One copy finished but its source was only partly deleted, one
+        # copy got halfway, and one move completed.
+        os.mkdir(os.path.join(self.dest, 'depth_1'))
+        shutil.copytree(copied, os.path.join(self.dest, 'depth_1', 'move_me'))
+        os.remove(os.path.join(copied, 'a_file.txt'))
+        journal.record(copied, 'copied')
+        os.mkdir(os.path.join(self.dest, 'move_me'))
+        journal.record(started, 'started')
+        journal.record(finished, 'done')
+        journal.mark_search_complete()
+        journal.close()
+        listed = self.record_listings()
+
+        move_by_regex.move_by_regex(self.source, self.dest, self.input_file,
+                                    self.log_file_path,
+                                    journal_file=journal_path, resume=True)
+
+        self.assertEqual(listed, [])
+        self.assertFalse(os.path.exists(copied))
+        self.assertFalse(os.path.exists(started))
+        self.assertTrue(os.path.exists(finished))
+        self.assertTrue(os.path.exists(os.path.join(self.dest, 'depth_1',
+                                                    'move_me', 'a_file.txt')))
+        self.assertTrue(os.path.exists(os.path.join(self.dest, 'move_me',
+                                                    'oooooooh_file.txt')))
+        resumed = move_journal.MoveJournal(journal_path, self.source,
+                                           self.dest, resume=True)
+        self.assertEqual(resumed.unfinished(), [])
+        self.assertIn(self.log_text.resuming.format(journal_file=journal_path),
+                      self.get_log_contents())
+
+    def native_name(self, raw):
+        """Return the native str for a file name given as bytes."""
+        if str is bytes:
+            return raw
+        return os.fsdecode(raw)
+
+    def test_resume_journalled_names_which_are_not_ascii(self):
+        raw_names = [b'caf\xc3\xa9_1', b'latin\xe9_1']
+        utf8, latin = [os.path.join(self.source, self.native_name(n))
+                       for n in raw_names]
+        for path in [utf8, latin]:
+            os.mkdir(path)
+        with open(self.input_file, 'wb') as input_file:
+            input_file.write(b'\n'.join(raw_names) + b'\n')
+        journal_path = os.path.join(self.logs, 'journal.txt')
+        journal = move_journal.MoveJournal(journal_path, self.source,
+                                           self.dest)
+        journal.record(utf8, 'planned', 'directories')
+        journal.record(latin, 'planned', 'directories')
+        journal.record(latin, 'failed')
+        journal.close()
+
+        resumed = move_journal.MoveJournal(journal_path, self.source,
+                                           self.dest, resume=True)
+        self.assertEqual(resumed.unfinished(),
+                         [(utf8, 'directories', 'planned')])
+        self.assertEqual([type(p) for p in resumed.planned], [str, str])
+        resumed.close()
+        stats = move_by_regex.move_by_regex(self.source, self.dest,
+                                            self.input_file,
+                                            self.log_file_path,
+                                            journal_file=journal_path,
+                                            resume=True)
+
+        # Planned once, and the failure not retried
+        self.assertEqual(stats.counts['moves'], 1)
+        self.assertEqual(stats.counts['errors'], 0)
+        self.assertFalse(os.path.exists(utf8))
+        self.assertTrue(os.path.exists(latin))
+
+    def test_plan_then_apply_moves_without_searching_again(self):
+        plan_path = os.path.join(self.logs, 'plan.json')
+        with open(self.input_file, 'w') as input_file:
+            input_file.write('*/move_me\nmove_me_too/regex{no_.*}')
+
+        move_by_regex.move_by_regex(self.source, self.dest, self.input_file,
+                                    self.log_file_path, plan_file=plan_path)
+
+        self.assertEqual(os.listdir(self.dest), [])
+        with open(plan_path) as f:
+            plan = json.load(f)
+        self.assertEqual(len(plan['search_result']['dirs_to_move']), 3)
+        listed = self.record_listings()
+
+        move_by_regex.move_by_regex(self.source, self.dest,
+                                    log_file=self.log_file_path,
+                                    apply_file=plan_path)
+
+        self.assertEqual(listed, [])
+        for path in plan['search_result']['dirs_to_move']:
+            self.assertFalse(os.path.exists(path))
+        self.assertTrue(os.path.exists(os.path.join(self.dest, 'move_me_too',
+                                                    'no_move')))
+        self.assertIn(self.log_text.applying_plan.format(plan_file=plan_path),
+                      self.get_log_contents())
+
+    def test_plan_round_trips_names_which_are_not_ascii(self):
+        plan_path = os.path.join(self.logs, 'plan.json')
+        utf8, latin = [os.path.join(self.source, self.native_name(n))
+                       for n in [b'caf\xc3\xa9_1', b'latin\xe9_1']]
+        search_result = {'dirs_to_move': [utf8],
+                         'files_to_move': [latin],
+                         'invalid_regex': [],
+                         'paths_matched': [self.native_name(b'caf\xc3\xa9_1'),
+                                           self.native_name(b'latin\xe9_1')],
+                         'paths_not_matched': [],
+                         'redundant_paths': []}
+
+        move_journal.write_plan(plan_path, self.source, search_result)
+        observed = move_journal.read_plan(plan_path, self.source)
+
+        self.assertEqual(observed, search_result)
+        self.assertEqual([type(p) for p in observed['dirs_to_move'] +
+                          observed['files_to_move']], [str, str])
+
+    def test_apply_in_read_only_mode_moves_nothing(self):
+        plan_path = os.path.join(self.logs, 'plan.json')
+        with open(self.input_file, 'w') as input_file:
+            input_file.write('*/move_me')
+        move_by_regex.move_by_regex(self.source, self.dest, self.input_file,
+                                    self.log_file_path, plan_file=plan_path)
+
+        move_by_regex.move_by_regex(self.source, self.dest,
+                                    log_file=self.log_file_path,
+                                    apply_file=plan_path, read_only=True)
+
+        self.assertEqual(os.listdir(self.dest), [])
+        self.assertTrue(os.path.exists(os.path.join(self.source, 'depth_1',
+                                                    'move_me')))
+        self.assertIn("Directories found:", self.get_log_contents())
+
+    def test_batch_runs_each_job_with_patterns_compiled_once(self):
+        manifest = os.path.join(self.logs, 'manifest.txt')
+        with open(self.input_file, 'w') as input_file:
+            input_file.write('move_me')
+        jobs = []
+        for name in ['depth_1', 'move_me_too']:
+            job_dest = os.path.join(self.dest, name)
+            os.mkdir(job_dest)
+            jobs.append((os.path.join(self.source, name), job_dest))
+        with open(manifest, 'w') as manifest_file:
+            for job_source, job_dest in jobs:
+                manifest_file.write('\t'.join([job_source, job_dest,
+                                               self.input_file]) + '\n')
+
+        stats = move_by_regex.move_batch(manifest, log_file=self.log_file_path)
+
+        for job_source, job_dest in jobs:
+            self.assertFalse(os.path.exists(os.path.join(job_source,
+                                                         'move_me')))
+            self.assertTrue(os.path.exists(os.path.join(job_dest, 'move_me')))
+        self.assertEqual(stats.counts['moves'], 2)
+        self.assertEqual(stats.counts['errors'], 0)
+        log_contents = self.get_log_contents()
+        patterns, digest = move_by_regex.read_patterns(self.input_file)
+        self.assertEqual(log_contents.count(
+            self.log_text.patterns_read.format(count=1,
+                                               path_file=self.input_file,
+                                               digest=digest)), 1)
+        self.assertIn(self.log_text.batch_stats_header.format(jobs=2),
+                      log_contents)
+
+    def test_batch_logs_each_job_in_one_block(self):
+        manifest = os.path.join(self.logs, 'manifest.txt')
+        with open(self.input_file, 'w') as input_file:
+            input_file.write('move_me\nnot_there')
+        jobs = []
+        for name in ['depth_1', 'move_me_too', 'depth_2']:
+            job_dest = os.path.join(self.dest, name)
+            os.mkdir(job_dest)
+            jobs.append((os.path.join(self.source, name), job_dest))
+        with open(manifest, 'w') as manifest_file:
+            for job_source, job_dest in jobs:
+                manifest_file.write('\t'.join([job_source, job_dest,
+                                               self.input_file]) + '\n')
+
+        move_by_regex.move_batch(manifest, log_file=self.log_file_path,
+                                 log_unmatched=True)
+
+        lines = self.get_log_contents().splitlines()
+        for n, (job_source, job_dest) in enumerate(jobs):
+            start = lines.index(self.log_text.batch_job.format(
+                n=n + 1, source=job_source, dest=job_dest))
+            end = lines.index(self.log_text.batch_job_stats_header.format(
+                source=job_source, dest=job_dest))
+            block = '\n'.join(lines[start:end])
+            self.assertIn(self.log_text.unmatched_header, block)
+            for other_source, other_dest in jobs:
+                if other_source != job_source:
+                    self.assertNotIn(other_source, block)
+
     def test_correct_behavior_on_no_pattern_file_direct(self):
         expected = self.log_text.no_patterns.format(path_file=self.input_file)
 